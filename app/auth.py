@@ -0,0 +1,287 @@
+import base64
+import collections
+import contextlib
+import hashlib
+import hmac
+import multiprocessing
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from root_dir import ROOT_DIR
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL
+    )
+'''
+SECRETS = 'CREATE TABLE IF NOT EXISTS secrets (name TEXT PRIMARY KEY, value BLOB NOT NULL)'
+INSERT_USER = 'INSERT INTO users (username, password) VALUES (?, ?)'
+SELECT_PASSWORD = 'SELECT password FROM users WHERE username = ?'
+UPDATE_PASSWORD = 'UPDATE users SET password = ? WHERE username = ? AND password = ?'
+SELECT_SECRET = 'SELECT value FROM secrets WHERE name = ?'
+INSERT_SECRET = 'INSERT OR IGNORE INTO secrets (name, value) VALUES (?, ?)'
+
+SCRYPT = (1 << 14, 8, 1)  # n, r, p: 16 MiB and some 50 ms per hash
+
+
+def derive(password, salt, n, r, p):
+    """scrypt; module level so a worker process can run it."""
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
+
+
+def encode_hash(salt, n, r, p, key):
+    return 'scrypt$%s$%s$%s$%s$%s' % (n, r, p, salt.hex(), key.hex())
+
+
+def resolved(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def chain(future, fn, executor=None):
+    """A Future for fn(result of future), or for the result of the Future fn returns.
+
+    fn runs on executor if one is given, otherwise on whichever thread
+    completes future, so anything slower than a few microseconds, like a
+    database write, should name an executor.
+    """
+    out = Future()
+
+    def settle(f):
+        try:
+            out.set_result(f.result())
+        except Exception as e:
+            out.set_exception(e)
+
+    def run(value):
+        try:
+            result = fn(value)
+        except Exception as e:
+            out.set_exception(e)
+            return
+        if isinstance(result, Future):
+            result.add_done_callback(settle)
+        else:
+            out.set_result(result)
+
+    def done(f):
+        try:
+            value = f.result()
+        except Exception as e:
+            out.set_exception(e)
+            return
+        if executor is None:
+            run(value)
+            return
+        try:
+            executor.submit(run, value)
+        except RuntimeError as e:  # shut down
+            out.set_exception(e)
+    future.add_done_callback(done)
+    return out
+
+
+class AuthStore(object):
+    """The users table, safe to use from any number of threads.
+
+    Each call borrows one of at most pool_size SQLite connections, so a
+    burst of logins runs in parallel instead of queueing on one cursor.
+    The database is in WAL mode, so reads go on while a signup
+    commits. The SQL is fixed text, so every connection prepares each
+    statement once and reuses it from its statement cache. Credentials
+    that verified recently are remembered, as a hash, for cache_ttl
+    seconds.
+
+    Passwords are stored as salted scrypt hashes. Hashing runs in a
+    pool of worker processes (threads with processes=False), queries and
+    commits on pool_size threads of their own, and the *_async methods
+    return Futures, so a caller never does the work on its own thread,
+    and a slow commit never holds up the delivery of a hash. Plaintext passwords left from older versions are
+    rehashed at their next successful login. A verified user can be
+    given a token, signed with a key kept in the database, which stays
+    valid across server restarts and is checked without any hashing.
+    """
+    POOL_SIZE = 4
+    CACHE_SIZE = 1024
+    CACHE_TTL = 60  # seconds
+    BUSY_TIMEOUT = 5000  # milliseconds to wait for another connection's write lock
+    TOKEN_TTL = 24 * 3600  # seconds
+
+    def __init__(self, path=None, pool_size=POOL_SIZE, cache_size=CACHE_SIZE, cache_ttl=CACHE_TTL,
+                 processes=True, workers=None):
+        self.path = path or os.path.join(ROOT_DIR, 'users.db')
+        self.pool_size = pool_size
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache_lock = threading.Lock()
+        self.verified = collections.OrderedDict()  # username -> (expiry, password hash)
+        self.pending = {}  # (username, password hash) -> Future of a check in progress
+        self.processes = processes
+        self.workers = workers or os.cpu_count() or 1
+        self.kdf_lock = threading.Lock()
+        self.kdf = None  # started on first use
+        self.db = ThreadPoolExecutor(pool_size)  # runs the *_async methods' SQL
+        with self.connection() as conn:
+            conn.execute(SCHEMA)
+            conn.execute(SECRETS)
+            conn.execute(INSERT_SECRET, ('token', os.urandom(32)))
+            conn.commit()
+            self.secret = conn.execute(SELECT_SECRET, ('token',)).fetchone()[0]
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT / 1000,
+                               check_same_thread=False, cached_statements=16)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=%d' % self.BUSY_TIMEOUT)
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        self.slots.acquire()
+        try:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = self.connect()
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self.idle.put(conn)
+        finally:
+            self.slots.release()
+
+    def executor(self):
+        with self.kdf_lock:
+            if self.kdf is None:
+                if self.processes:
+                    # spawn: forking a process full of threads can inherit a held lock
+                    self.kdf = ProcessPoolExecutor(self.workers, multiprocessing.get_context('spawn'))
+                else:
+                    self.kdf = ThreadPoolExecutor(self.workers)
+            return self.kdf
+
+    def hash_password(self, password):
+        """Future for the stored form of password."""
+        salt = os.urandom(16)
+        return chain(self.executor().submit(derive, password, salt, *SCRYPT),
+                     lambda key: encode_hash(salt, *SCRYPT, key))
+
+    def add_user_async(self, username, password):
+        """Future that is False if the username is taken."""
+        return chain(self.hash_password(password), lambda stored: self.insert(username, stored), self.db)
+
+    def insert(self, username, stored):
+        with self.connection() as conn:
+            try:
+                conn.execute(INSERT_USER, (username, stored))
+                conn.commit()
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                return False
+        return True
+
+    def add_user(self, username, password):
+        return self.add_user_async(username, password).result()
+
+    def verify_user_async(self, username, password):
+        digest = hashlib.sha256(password.encode()).digest()
+        now = time.monotonic()
+        with self.cache_lock:
+            entry = self.verified.get(username)
+            if entry is not None and entry[0] > now and hmac.compare_digest(entry[1], digest):
+                self.verified.move_to_end(username)
+                return resolved(True)
+            # a client retrying a login it has already sent waits on the same check
+            future = self.pending.get((username, digest))
+            if future is not None:
+                return future
+            future = chain(self.db.submit(self.stored_password, username),
+                           lambda stored: self.check(username, password, stored))
+            self.pending[(username, digest)] = future
+
+        def done(f):
+            with self.cache_lock:
+                self.pending.pop((username, digest), None)
+            if not f.exception() and f.result():
+                self.remember(username, digest)
+        future.add_done_callback(done)
+        return future
+
+    def stored_password(self, username):
+        with self.connection() as conn:
+            row = conn.execute(SELECT_PASSWORD, (username,)).fetchone()
+        return row and row[0]
+
+    # password against the stored form of it; a bool, or a Future of one while scrypt runs
+    def check(self, username, password, stored):
+        if stored is None:
+            return False
+        if not stored.startswith('scrypt$'):
+            # plaintext from before passwords were hashed
+            ok = hmac.compare_digest(stored.encode(), password.encode())
+            if ok:
+                chain(self.hash_password(password), lambda new: self.upgrade(username, stored, new), self.db)
+            return ok
+        _, n, r, p, salt, key = stored.split('$')
+        return chain(self.executor().submit(derive, password, bytes.fromhex(salt), int(n), int(r), int(p)),
+                     lambda derived: hmac.compare_digest(derived, bytes.fromhex(key)))
+
+    def verify_user(self, username, password):
+        return self.verify_user_async(username, password).result()
+
+    def upgrade(self, username, old, stored):
+        with self.connection() as conn:
+            conn.execute(UPDATE_PASSWORD, (stored, username, old))
+            conn.commit()
+
+    def remember(self, username, digest):
+        with self.cache_lock:
+            self.verified[username] = (time.monotonic() + self.cache_ttl, digest)
+            self.verified.move_to_end(username)
+            while len(self.verified) > self.cache_size:
+                self.verified.popitem(last=False)
+
+    def sign(self, payload):
+        return hmac.new(self.secret, payload.encode(), hashlib.sha256).hexdigest()
+
+    def issue_token(self, username, ttl=TOKEN_TTL):
+        payload = '%s:%d' % (base64.urlsafe_b64encode(username.encode()).decode(), time.time() + ttl)
+        return '%s:%s' % (payload, self.sign(payload))
+
+    def check_token(self, token):
+        """The username a token was issued to, or None if it is forged or expired."""
+        try:
+            name, expiry, signature = token.strip().split(':')
+            if not hmac.compare_digest(signature, self.sign('%s:%s' % (name, expiry))):
+                return None
+            if int(expiry) < time.time():
+                return None
+            return base64.urlsafe_b64decode(name.encode()).decode()
+        except ValueError:
+            return None
+
+    def close(self):
+        with self.kdf_lock:
+            if self.kdf is not None:
+                # wait, or the hashing processes outlive us once the caller exits
+                self.kdf.shutdown(wait=True)
+                self.kdf = None
+        self.db.shutdown(wait=True)  # after the hashes, whose results it may still be writing
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
@@ -0,0 +1,104 @@
+"""LOOKUP throughput of the index under a mixed read/write load.
+
+Compares RfcIndex with the single-lock dict index the server used
+before, for an increasing number of reader threads while one writer
+keeps adding and removing peers.
+
+    python benchmarks/index_bench.py --rfcs 10000 --seconds 2
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from index import RfcIndex
+
+
+class LockedIndex(object):
+    """The original index: one lock around a defaultdict and a dict of (title, set)."""
+
+    def __init__(self):
+        self.peers = defaultdict(set)
+        self.rfcs = {}
+        self.lock = threading.Lock()
+
+    def add(self, peer, num, title):
+        with self.lock:
+            self.peers[peer].add(num)
+            self.rfcs.setdefault(num, (title, set()))[1].add(peer)
+            return self.rfcs[num]
+
+    def get(self, num):
+        with self.lock:
+            entry = self.rfcs.get(num)
+            return entry and (entry[0], list(entry[1]))
+
+    def remove_peer(self, peer):
+        with self.lock:
+            nums = self.peers.pop(peer, set())
+            for num in nums:
+                self.rfcs[num][1].discard(peer)
+                if not self.rfcs[num][1]:
+                    self.rfcs.pop(num)
+            return nums, []
+
+
+def lookup(index, num):
+    entry = index.get(num)
+    if entry is None:
+        return ''
+    return ''.join('RFC %s %s %s %s\n' % (num, entry[0], peer[0], peer[1]) for peer in entry[1])
+
+
+def run(index, readers, rfcs, seconds):
+    for n in range(rfcs):
+        for p in range(3):
+            index.add(('seed%d' % p, 1000 + p), n, 'title %d' % n)
+    stop = threading.Event()
+    counts = [0] * readers
+    writes = [0]
+
+    def reader(i):
+        rng = random.Random(i)
+        while not stop.is_set():
+            for _ in range(100):
+                lookup(index, rng.randrange(rfcs))
+            counts[i] += 100
+
+    def writer():
+        rng = random.Random(-1)
+        peer = 0
+        while not stop.is_set():
+            peer += 1
+            for _ in range(10):
+                index.add(('churn%d' % peer, 2000), rng.randrange(rfcs), 'churn')
+            index.remove_peer(('churn%d' % peer, 2000))
+            writes[0] += 11
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    threads.append(threading.Thread(target=writer))
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return sum(counts) / seconds, writes[0] / seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rfcs', type=int, default=10000)
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--readers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    print('%-10s %8s %14s %12s' % ('index', 'readers', 'lookups/s', 'writes/s'))
+    for readers in args.readers:
+        for name, cls in (('locked', LockedIndex), ('striped', RfcIndex)):
+            reads, writes = run(cls(), readers, args.rfcs, args.seconds)
+            print('%-10s %8d %14.0f %12.0f' % (name, readers, reads, writes))
@@ -0,0 +1,326 @@
+"""Throughput and latency of the index server under simulated peers.
+
+Starts a server on a free local port, connects --peers simulated peers
+over asyncio, has each register --files RFCs and then send requests
+drawn from --mix as fast as answers come back (or with --think seconds
+between them), while --churn peers a second leave and rejoin. Prints
+throughput and p50/p99/p999 latency per verb plus the server's peak
+RSS, and writes everything to --json so runs can be compared.
+
+    python benchmarks/load_bench.py --peers 2000 --seconds 20 --json before.json
+    python benchmarks/load_bench.py --mix lookup=60,add=10,list=10,login=10,token=10 --mode async
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+APP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+V = 'P2P-CI/1.0'
+USERS = 20  # accounts created for LOGIN; each SIGNUP costs the server a password hash
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        verb, _, weight = part.partition('=')
+        verb = verb.strip().lower()
+        if verb not in ('add', 'lookup', 'list', 'login', 'token', 'search', 'heartbeat'):
+            raise argparse.ArgumentTypeError('unknown verb %r' % verb)
+        mix[verb] = float(weight or 1)
+    return mix
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def rss(pid):
+    """Resident set size of pid in bytes, from /proc; None where there is no /proc."""
+    try:
+        with open('/proc/%d/status' % pid) as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Peer(object):
+    """One simulated peer: a connection to the server and the RFCs it shares."""
+
+    def __init__(self, bench, n):
+        self.bench = bench
+        self.n = n
+        self.host = 'bench%d' % n
+        self.port = 10000 + n % 50000
+        self.reader = self.writer = None
+        self.token = None
+        self.rejoin = False
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection('localhost', self.bench.port)
+        records = ''.join('%d - bench title %d\n' % (num, num) for num in self.bench.files_of(self.n))
+        await self.call('ADD BULK %s\nHost: %s\nPort: %s\nContent-Length: %d\n' %
+                        (V, self.host, self.port, len(records)), records.encode(), 'add_bulk')
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def call(self, head, body=b'', verb=None):
+        began = time.perf_counter()
+        self.writer.write(head.encode() + b'\n' + body)
+        res = (await self.reader.readuntil(b'\n\n')).decode()
+        self.bench.record(verb, res.split(None, 2)[1], time.perf_counter() - began)
+        return res
+
+    async def request(self, verb):
+        bench = self.bench
+        rng = bench.rng
+        if verb == 'add':
+            num = rng.randrange(bench.rfcs)
+            await self.call('ADD RFC %d %s\nHost: %s\nPort: %s\nTitle: bench title %d\n' %
+                            (num, V, self.host, self.port, num), verb=verb)
+        elif verb == 'lookup':
+            await self.call('LOOKUP RFC %d %s\nHost: %s\nPort: %s\n' %
+                            (rng.randrange(bench.rfcs), V, self.host, self.port), verb=verb)
+        elif verb == 'list':
+            await self.call('LIST ALL %d %d %s\nHost: %s\nPort: %s\n' %
+                            (rng.randrange(bench.rfcs), bench.list_page, V, self.host, self.port), verb=verb)
+        elif verb == 'search':
+            await self.call('SEARCH RFC %s\nTitle: title %d\n' % (V, rng.randrange(bench.rfcs)), verb=verb)
+        elif verb == 'heartbeat':
+            await self.call('HEARTBEAT %s\nHost: %s\nPort: %s\n' % (V, self.host, self.port), verb=verb)
+        elif verb == 'token' and self.token:
+            await self.call('LOGIN %s\nUsername: bench%d\nToken: %s\n' % (V, self.n % USERS, self.token), verb=verb)
+        else:
+            user = self.n % USERS
+            res = await self.call('LOGIN %s\nUsername: bench%d\nPassword: bench%d\n' % (V, user, user),
+                                  verb='login')
+            for line in res.splitlines():
+                if line.startswith('Token:'):
+                    self.token = line.split(None, 1)[1]
+
+
+class Bench(object):
+    def __init__(self, args, port):
+        self.args = args
+        self.port = port
+        self.rfcs = args.rfcs
+        self.list_page = args.list_page
+        self.rng = random.Random(args.seed)
+        self.verbs = list(args.mix)
+        self.weights = [args.mix[verb] for verb in self.verbs]
+        self.measuring = False
+        self.latencies = {}  # verb -> [seconds]
+        self.statuses = {}  # verb -> {status: count}
+        self.errors = 0
+        self.rejoins = 0
+
+    def files_of(self, n):
+        rng = random.Random(n)
+        return sorted(rng.sample(range(self.rfcs), min(self.args.files, self.rfcs)))
+
+    def record(self, verb, status, elapsed):
+        if not self.measuring or verb is None:
+            return
+        self.latencies.setdefault(verb, []).append(elapsed)
+        counts = self.statuses.setdefault(verb, {})
+        counts[status] = counts.get(status, 0) + 1
+
+    async def run_peer(self, peer, stop):
+        while not stop.is_set():
+            try:
+                if peer.rejoin:
+                    peer.rejoin = False
+                    peer.close()
+                if peer.writer is None:
+                    await peer.connect()
+                await peer.request(self.rng.choices(self.verbs, self.weights)[0])
+                if self.args.think:
+                    await asyncio.sleep(self.rng.expovariate(1 / self.args.think))
+            except (OSError, ValueError, asyncio.IncompleteReadError, IndexError):
+                if self.measuring:
+                    self.errors += 1
+                peer.close()
+                await asyncio.sleep(0.1)
+
+    async def churn(self, peers, stop):
+        if not self.args.churn:
+            return
+        while not stop.is_set():
+            await asyncio.sleep(self.rng.expovariate(self.args.churn))
+            # leaving drops every record of the peer; it reconnects and registers again
+            self.rng.choice(peers).rejoin = True
+            self.rejoins += 1
+
+    async def main(self):
+        for user in range(USERS):
+            peer = Peer(self, user)
+            peer.reader, peer.writer = await asyncio.open_connection('localhost', self.port)
+            await peer.call('SIGNUP %s\nUsername: bench%d\nPassword: bench%d\n' % (V, user, user))
+            peer.close()
+        peers = [Peer(self, n) for n in range(self.args.peers)]
+        began = time.perf_counter()
+        gate = asyncio.Semaphore(self.args.connect_concurrency)
+
+        async def connect(peer):
+            async with gate:
+                await peer.connect()
+        await asyncio.gather(*(connect(peer) for peer in peers))
+        connected = time.perf_counter() - began
+        print('%d peers registered %d RFCs each in %.2fs' % (len(peers), self.args.files, connected))
+
+        stop = asyncio.Event()
+        tasks = [asyncio.ensure_future(self.run_peer(peer, stop)) for peer in peers]
+        tasks.append(asyncio.ensure_future(self.churn(peers, stop)))
+        await asyncio.sleep(self.args.warmup)
+        self.measuring = True
+        began = time.perf_counter()
+        await asyncio.sleep(self.args.seconds)
+        self.measuring = False
+        elapsed = time.perf_counter() - began
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for peer in peers:
+            peer.close()
+        return connected, elapsed
+
+
+def sample_rss(pid, peak, stop):
+    while not stop.is_set():
+        value = rss(pid)
+        if value is not None:
+            peak[0] = max(peak[0], value)
+        stop.wait(0.25)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--peers', type=int, default=1000)
+    parser.add_argument('--files', type=int, default=20, help='RFCs each peer registers')
+    parser.add_argument('--rfcs', type=int, default=10000, help='distinct RFC numbers')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('lookup=70,add=10,list=5,heartbeat=10,token=5'),
+                        help='verb=weight,...; verbs: add lookup list search heartbeat login token')
+    parser.add_argument('--churn', type=float, default=5, help='peers a second that leave and rejoin')
+    parser.add_argument('--think', type=float, default=0, help='mean seconds between a peer\'s requests')
+    parser.add_argument('--list-page', type=int, default=100)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--connect-concurrency', type=int, default=200)
+    parser.add_argument('--mode', choices=('thread', 'async'), default='thread')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write the results here')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                        help='after --, extra arguments for server.py, e.g. -- --workers 64')
+    args = parser.parse_args()
+
+    # thousands of sockets on each side; the server inherits the raised limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    want = args.peers + USERS + 256
+    if soft < want:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(want, hard), hard))
+
+    state = tempfile.mkdtemp(prefix='load_bench')
+    port = free_port()
+    extra = [arg for arg in args.server_args if arg != '--']
+    server = subprocess.Popen([sys.executable, os.path.join(APP, 'server.py'), '--port', str(port),
+                               '--mode', args.mode, '--state', '', '--db', os.path.join(state, 'users.db'),
+                               '--max-connections', str(args.peers + USERS + 100)] + extra,
+                              cwd=APP, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              start_new_session=True)  # its own process group, hashing workers included
+    peak = [0]
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_rss, args=(server.pid, peak, stop), daemon=True)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(('localhost', port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        idle_rss = rss(server.pid)
+        sampler.start()
+        bench = Bench(args, port)
+        connected, elapsed = asyncio.run(bench.main())
+        final_rss = rss(server.pid)
+    finally:
+        stop.set()
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            os.killpg(server.pid, signal.SIGKILL)
+            server.wait()
+        shutil.rmtree(state, ignore_errors=True)
+
+    verbs = {}
+    total = 0
+    for verb, latencies in sorted(bench.latencies.items()):
+        latencies.sort()
+        total += len(latencies)
+        verbs[verb] = {'requests': len(latencies), 'per_second': len(latencies) / elapsed,
+                       'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99),
+                       'p999': percentile(latencies, 0.999), 'max': latencies[-1],
+                       'statuses': bench.statuses[verb]}
+    everything = sorted(x for latencies in bench.latencies.values() for x in latencies)
+    result = {
+        'revision': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(), 'platform': platform.platform(),
+        'args': {key: value for key, value in vars(args).items() if key != 'json'},
+        'connect_seconds': connected, 'seconds': elapsed,
+        'requests': total, 'per_second': total / elapsed, 'errors': bench.errors, 'rejoins': bench.rejoins,
+        'p50': percentile(everything, 0.5), 'p99': percentile(everything, 0.99),
+        'p999': percentile(everything, 0.999),
+        'rss': {'idle': idle_rss, 'peak': peak[0] or None, 'final': final_rss},
+        'verbs': verbs,
+    }
+
+    def ms(value):
+        return '%9.2f' % (value * 1000) if value is not None else '%9s' % '-'
+    print('%-10s %9s %9s %9s %9s %9s  %s' % ('verb', 'req/s', 'p50 ms', 'p99 ms', 'p999 ms', 'max ms', 'statuses'))
+    for verb, stats in verbs.items():
+        print('%-10s %9.0f %s %s %s %s  %s' % (verb, stats['per_second'], ms(stats['p50']), ms(stats['p99']),
+                                              ms(stats['p999']), ms(stats['max']), stats['statuses']))
+    print('%-10s %9.0f %s %s %s' % ('all', result['per_second'], ms(result['p50']), ms(result['p99']),
+                                    ms(result['p999'])))
+    print('errors %d, rejoins %d, server RSS idle %s MiB, peak %s MiB' % (
+        bench.errors, bench.rejoins,
+        '%.1f' % (idle_rss / 2 ** 20) if idle_rss else '-', '%.1f' % (peak[0] / 2 ** 20) if peak[0] else '-'))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(result, file, indent=2)
+        print('results written to %s' % args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""Peer-to-peer GET throughput over loopback.
+
+Starts an uploading and a downloading Client in one process, without
+the login prompt or the menu, and times whole-file downloads through
+Client.get_file for every combination of --sizes, --concurrency
+(downloads running at once) and --bufsizes (bytes per recv on the
+downloading side). Each combination runs in a fresh process, so its
+peak RSS is its own. Prints MB/s, CPU seconds per GB moved (both
+sides) and peak memory, and writes them to --json.
+
+    python benchmarks/transfer_bench.py --sizes 1K 1M 64M 1G --concurrency 1 4 --bufsizes 16K 64K 1M
+    python benchmarks/transfer_bench.py --content text --json text.json
+"""
+import argparse
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+APP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(APP)
+from merkle import Verifier
+from pool import PeerPool
+from transfer import PartialDownload
+
+UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+
+def size(text):
+    text = text.strip().upper().rstrip('B')
+    if text[-1:] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def human(n):
+    for unit in ('G', 'M', 'K'):
+        if n >= UNITS[unit] and n % UNITS[unit] == 0:
+            return '%d%s' % (n // UNITS[unit], unit)
+    return str(n)
+
+
+def load_client():
+    spec = importlib.util.spec_from_file_location('bench_client', os.path.join(APP, 'client1', 'client.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_file(path, length, content, seed=1):
+    """length bytes of random data, or of RFC-like text that compresses about as well as the real thing."""
+    rng = random.Random(seed)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 10)))
+             for _ in range(2000)]
+    with open(path, 'wb') as file:
+        file.write(b'Benchmark RFC\n'[:length])
+        left = length - min(length, 14)
+        while left > 0:
+            if content == 'random':
+                block = os.urandom(min(left, 1 << 20))
+            else:
+                block = ' '.join(rng.choice(words) for _ in range(20000)).encode()[:left]
+            file.write(block)
+            left -= len(block)
+
+
+def run_case(args):
+    """Time one (size, concurrency, bufsize) combination in this process; returns its results."""
+    root = tempfile.mkdtemp(prefix='transfer_bench', dir=args.tmp)
+    quiet = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, quiet  # the clients narrate every transfer
+    try:
+        client = load_client()
+        up = os.path.join(root, 'up')
+        os.makedirs(up)
+        write_file(os.path.join(up, 'file1.txt'), args.size, args.content)
+        db = os.path.join(root, 'users.db')
+        uploader = client.Client(DIR=up, register=False, upload_slots=args.concurrency, db=db)
+        threading.Thread(target=uploader.init_upload, daemon=True).start()
+        while uploader.UPLOAD_PORT is None:
+            time.sleep(0.01)
+        downloader = client.Client(DIR=os.path.join(root, 'down'), register=False, db=db)
+        downloader.pool = PeerPool(per_peer=args.concurrency, bufsize=args.bufsize)
+
+        def download(path):
+            partial = PartialDownload(path)
+            downloader.get_file(1, partial, 'localhost', uploader.UPLOAD_PORT, Verifier())
+            partial.finish()
+            os.remove(path)
+
+        # first GET builds the uploader's compressed copy, as a popular file's would be
+        download(os.path.join(root, 'warm.txt'))
+
+        moved = [0] * args.concurrency
+        deadline = [None]
+
+        def worker(i):
+            path = os.path.join(root, 'down', 'copy%d.txt' % i)
+            while True:
+                download(path)
+                moved[i] += args.size
+                if time.perf_counter() >= deadline[0]:
+                    return
+
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        began = time.perf_counter()
+        deadline[0] = began + args.seconds
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - began
+        after = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        sys.stdout = stdout
+        quiet.close()
+        shutil.rmtree(root, ignore_errors=True)
+    total = sum(moved)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return {'size': args.size, 'concurrency': args.concurrency, 'bufsize': args.bufsize,
+            'content': args.content, 'transfers': total // args.size, 'bytes': total, 'seconds': elapsed,
+            'mb_per_second': total / elapsed / 1e6, 'cpu_seconds': cpu,
+            'cpu_per_gb': cpu / (total / 1e9) if total else None,
+            # ru_maxrss is KiB on Linux, bytes on macOS
+            'peak_rss': after.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=size, nargs='+', default=[size(s) for s in ('1K', '1M', '64M')])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--bufsizes', type=size, nargs='+', default=[size(s) for s in ('16K', '64K', '1M')])
+    parser.add_argument('--content', choices=('random', 'text'), default='random',
+                        help='random bytes, or text that the uploader will compress')
+    parser.add_argument('--seconds', type=float, default=2, help='minimum time per combination')
+    parser.add_argument('--tmp', help='directory for the files; needs room for size x (concurrency + 2)')
+    parser.add_argument('--json', help='write the results here')
+    # one combination, run by the parent in a child process
+    parser.add_argument('--size', type=size, help=argparse.SUPPRESS)
+    parser.add_argument('--bufsize', type=size, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.size is not None:
+        args.concurrency = args.concurrency[0]
+        print(json.dumps(run_case(args)))
+        return
+
+    results = []
+    print('%8s %5s %8s %10s %10s %10s %10s' % ('size', 'conc', 'bufsize', 'transfers', 'MB/s', 'CPU s/GB',
+                                               'peak MiB'))
+    for length, concurrency, bufsize in itertools.product(args.sizes, args.concurrency, args.bufsizes):
+        command = [sys.executable, os.path.abspath(__file__), '--size', str(length), '--bufsize', str(bufsize),
+                   '--concurrency', str(concurrency), '--content', args.content, '--seconds', str(args.seconds)]
+        if args.tmp:
+            command += ['--tmp', args.tmp]
+        child = subprocess.run(command, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+        if child.returncode:
+            print('%8s %5d %8s  failed' % (human(length), concurrency, human(bufsize)))
+            continue
+        result = json.loads(child.stdout.decode().strip().splitlines()[-1])
+        results.append(result)
+        print('%8s %5d %8s %10d %10.1f %10s %10.1f' % (
+            human(length), concurrency, human(bufsize), result['transfers'], result['mb_per_second'],
+            '%.2f' % result['cpu_per_gb'] if result['cpu_per_gb'] is not None else '-',
+            result['peak_rss'] / 2 ** 20))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'revision': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(), 'platform': platform.platform(),
+                       'content': args.content, 'results': results}, file, indent=2)
+        print('results written to %s' % args.json)
+
+
+if __name__ == '__main__':
+    main()
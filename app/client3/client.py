@@ -1,3 +1,6 @@
+import argparse
+import logging
+import re
 import socket
 import threading
 import platform
@@ -10,6 +13,18 @@ from pathlib import Path
 # Add the parent directory to the system path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from root.database import setup_database, add_user, verify_user
+from protocol import Connection, SocketReader, frame
+from transfer import parse_range, receive, PartialDownload
+from merkle import ManifestCache, Verifier, fetch_manifest
+from swarm import Swarm, SwarmError
+from lookup_cache import LookupCache
+from pool import PeerPool
+from uploads import UploadScheduler, Busy
+from compression import CompressedCache, MIN_SIZE, accept_encoding, negotiate, decompress
+import logs
+from logs import event
+
+log = logging.getLogger('p2p.client')
 
 
 class MyException(Exception):
@@ -17,7 +32,17 @@ class MyException(Exception):
 
 
 class Client(object):
-    def __init__(self, serverhost='localhost', V='P2P-CI/1.0', DIR='SHARED_FILES'):
+    LIST_PAGE = 500  # RFCs per LIST page
+    BULK_SIZE = 1000  # RFCs per ADD BULK request
+    HEARTBEAT_INTERVAL = 30  # seconds between heartbeats, at most
+    UPLOAD_IDLE = 30  # seconds an idle peer connection is kept open for more GETs
+    LOOKUP_TTL = 30  # seconds a LOOKUP answer is reused
+    LOOKUP_CACHE_SIZE = 1024  # RFCs whose LOOKUP answers are kept
+    UPLOAD_SLOTS = 4  # files uploaded at once; other downloaders queue
+
+    def __init__(self, serverhost='localhost', V='P2P-CI/1.0', DIR='SHARED_FILES', register=True,
+                 upload_slots=UPLOAD_SLOTS, upload_rate=0, auto_select=None,
+                 compress_cache=CompressedCache.MAX_BYTES, db=None):
         self.SERVER_HOST = serverhost
         self.SERVER_PORT = 7734
         self.V = V
@@ -26,9 +51,19 @@ class Client(object):
 
         self.UPLOAD_PORT = None
         self.shareable = True
+        self.register = register  # share everything in DIR at startup
+        # take the best ranked peer instead of asking; the default when nobody is at the terminal
+        self.auto_select = not sys.stdin.isatty() if auto_select is None else auto_select
+        self.manifests = ManifestCache()
+        self.lookups = LookupCache(self.LOOKUP_CACHE_SIZE, self.LOOKUP_TTL)
+        self.pool = PeerPool()  # idle connections to other peers, reused across downloads
+        # upload_rate is in bytes per second for all uploads together, 0 for no limit
+        self.uploads = UploadScheduler(upload_slots, upload_rate)
+        # compressed copies of shared files, so a popular file is compressed once per change
+        self.compressed = CompressedCache(os.path.join(self.DIR, '.compressed'), compress_cache)
 
         # Database setup
-        setup_database()
+        setup_database(db)
 
     def start(self):
 
@@ -42,9 +77,10 @@ class Client(object):
 
         print('Connecting to the server %s:%s' %
               (self.SERVER_HOST, self.SERVER_PORT))
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            self.server.connect((self.SERVER_HOST, self.SERVER_PORT))
+            soc.connect((self.SERVER_HOST, self.SERVER_PORT))
+            self.server = Connection(soc, self.notified)
         except Exception:
             print('Server Not Available.')
             print("\n----------------------------------------------------------")
@@ -61,6 +97,10 @@ class Client(object):
             pass
         print('Listening on the upload port %s' % self.UPLOAD_PORT)
 
+        if self.register:
+            self.register_all()
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+
         # interactive shell
         self.cli()
 
@@ -144,59 +184,131 @@ class Client(object):
             handler.start()
         self.uploader.close()
 
+    # serve GETs on one connection until the peer closes it or goes idle
     def handle_upload(self, soc, addr):
-        header = soc.recv(1024).decode().splitlines()
+        soc.settimeout(self.UPLOAD_IDLE)
+        # the head and body go out in separate writes; Nagle would hold the body
+        # until the downloader's delayed ACK of the head, 40 ms on small files
+        soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = SocketReader(soc)
         try:
-            version = header[0].split()[-1]
-            num = header[0].split()[-2]
-            method = header[0].split()[0]
-            path = '%s/file%s.txt' % (self.DIR, num)
-            if version != self.V:
-                soc.sendall(str.encode(
-                    self.V + ' 505 P2P-CI Version Not Supported\n'))
-            elif not Path(path).is_file():
-                soc.sendall(str.encode(self.V + ' 404 Not Found\n'))
-            elif method == 'GET':
-                header = self.V + ' 200 OK\n'
+            while True:
+                req = reader.read_message()
+                if req is None:
+                    break
+                self.serve_upload(soc, req)
+                if (req.header('Connection') or '').lower() == 'close':
+                    break
+        except (ConnectionError, socket.timeout):
+            pass  # the downloader went away, or kept the connection idle too long
+        except Exception as e:
+            event(log, logging.WARNING, 'upload failed', error=e)
+            try:
+                soc.sendall(frame(self.V + ' 400 Bad Request\n'))
+            except OSError:
+                pass
+        finally:
+            soc.close()
+
+    def serve_upload(self, soc, req):
+        version = req.start[-1]
+        num = req.start[-2]
+        method = req.start[0]
+        path = '%s/file%s.txt' % (self.DIR, num)
+        if version != self.V:
+            soc.sendall(frame(
+                self.V + ' 505 P2P-CI Version Not Supported\n'))
+        elif not Path(path).is_file():
+            soc.sendall(frame(self.V + ' 404 Not Found\n'))
+        elif method == 'GET':
+            try:
+                upload = self.uploads.acquire(soc.getpeername(), num)
+            except Busy as e:
+                soc.sendall(frame(self.V + ' 503 Service Unavailable\n'
+                                  'Retry-After: %s\n' % e.retry_after))
+                return
+            # the exact on-disk bytes; length and mtime come from the open file
+            with upload, open(path, 'rb') as file:
+                stat = os.fstat(file.fileno())
+                start, end = 0, stat.st_size - 1
+                if req.header('Range'):
+                    try:
+                        start, end = parse_range(req.header('Range'), stat.st_size)
+                    except ValueError:
+                        soc.sendall(frame(self.V + ' 416 Range Not Satisfiable\n'
+                                          'Content-Range: bytes */%s\n' % stat.st_size))
+                        return
+                    header = self.V + ' 206 Partial Content\n'
+                    header += 'Content-Range: bytes %s-%s/%s\n' % (start, end, stat.st_size)
+                else:
+                    header = self.V + ' 200 OK\n'
+                # whole files only: a range of a compressed stream is of no use to the downloader
+                body, count = file, end - start + 1
+                encoding = None
+                if not req.header('Range') and stat.st_size >= MIN_SIZE:
+                    encoding = negotiate(req.header('Accept-Encoding'))
+                if encoding:
+                    body = self.compressed.open(path, file, encoding)
+                    if body is not None:
+                        count = os.fstat(body.fileno()).st_size
+                        if count >= stat.st_size:
+                            body.close()
+                            body, encoding = file, None
+                    elif self.compressed.compressible(path, file, encoding):
+                        # compressed as it is sent, so the head never waits for the whole file
+                        body, count = self.compressed.stream(path, file, encoding), None
+                    else:
+                        body, encoding = file, None
+                if encoding:
+                    start = 0
+                    header += 'Content-Encoding: %s\n' % encoding
+                    header += 'Decoded-Length: %s\n' % stat.st_size
                 header += 'Data: %s\n' % (time.strftime(
                     "%a, %d %b %Y %H:%M:%S GMT", time.gmtime()))
                 header += 'OS: %s\n' % (platform.platform())
                 header += 'Last-Modified: %s\n' % (time.strftime(
-                    "%a, %d %b %Y %H:%M:%S GMT", time.gmtime(os.path.getmtime(path))))
-                header += 'Content-Length: %s\n' % (os.path.getsize(path))
+                    "%a, %d %b %Y %H:%M:%S GMT", time.gmtime(stat.st_mtime)))
+                if count is None:
+                    header += 'Transfer-Encoding: chunked\n'
+                else:
+                    header += 'Content-Length: %s\n' % count
                 header += 'Content-Type: %s\n' % (
-                    mimetypes.MimeTypes().guess_type(path)[0])
-                soc.sendall(header.encode())
+                    mimetypes.guess_type(path)[0])
                 # Uploading
                 try:
-                    print('\nUploading...')
-
-                    send_length = 0
-                    with open(path, 'r') as file:
-                        to_send = file.read(1024)
-                        while to_send:
-                            send_length += len(to_send.encode())
-                            soc.sendall(to_send.encode())
-                            to_send = file.read(1024)
+                    soc.sendall(frame(header))
+                    if count is None:
+                        upload.send_chunks(soc, body)
+                    else:
+                        upload.send(soc, body, start, count)
+                except (ConnectionError, socket.timeout):
+                    raise
                 except Exception:
                     raise MyException('Uploading Failed')
-                print('Uploading Completed.')
-                # Restore CLI
-                print('\n1: Upload \n2: Search \n3: List All  \n4: Download \n5: Shut Down\nEnter your request number : ')
-                print("----------------------------------------------------------\n")
-
-            else:
-                raise MyException('Bad Request.')
-        except Exception:
-            soc.sendall(str.encode(self.V + '  400 Bad Request\n'))
-        finally:
-            soc.close()
+                finally:
+                    if body is not file:
+                        body.close()
+            if log.isEnabledFor(logging.INFO):
+                stats = self.uploads.stats()
+                event(log, logging.INFO, 'upload', peer=upload.peer[0], num=num, bytes=upload.sent,
+                      encoding=encoding or 'identity', kib_per_second=round(upload.rate / 1024),
+                      active=stats['active'], queued=stats['queued'])
+
+        elif method == 'MANIFEST':
+            manifest = self.manifests.get(path)
+            header = self.V + ' 200 OK\n'
+            header += 'Root: %s\n' % manifest.root
+            header += 'Size: %s\n' % manifest.size
+            header += 'Chunk-Size: %s\n' % manifest.chunk_size
+            soc.sendall(frame(header, manifest.text().encode()))
+        else:
+            raise MyException('Bad Request.')
 
     def add(self, num=None, title=None):
         if not num:
             print()
             num = input('Enter the File number: ')
-            if not num.isdigit():
+            if not re.fullmatch(r'[1-9]\d*', num):
                 raise MyException('Invalid Input.')
             title = input('Enter the File title: ')
         
@@ -206,124 +318,369 @@ class Client(object):
         print(file)
         if not file.is_file():
             raise MyException('File does not Exists!')
+        title = title or self.file_title(num)  # the server needs a title to index
         msg = 'ADD RFC %s %s\n' % (num, self.V)
         msg += 'Host: %s\n' % socket.gethostname()
         msg += 'Port: %s\n' % self.UPLOAD_PORT
         msg += 'Title: %s\n' % title
-        self.server.sendall(msg.encode())
-        res = self.server.recv(1024).decode()
-        print('Receive response: \n%s' % res)
+        msg += 'Root: %s\n' % self.manifests.get(str(file)).root
+        res = self.server.call(msg)
+        # we hold it now; the cached holders are out of date
+        self.lookups.invalidate(str(num))
+        print('Receive response: \n%s' % res.text())
+
+    # share every file<num>.txt in DIR; Merkle roots follow once the files are hashed.
+    # file007.txt is skipped: the server would list it as RFC 7, and GET RFC 7 asks for file7.txt
+    def register_all(self):
+        nums = []
+        for name in os.listdir(self.DIR):
+            match = re.fullmatch(r'file([1-9]\d*)\.txt', name)
+            if match:
+                nums.append(match.group(1))
+        if not nums:
+            return
+        count = self.add_bulk([(num, self.file_title(num), '-') for num in nums])
+        print('Shared %s files from %s' % (count, self.DIR))
+        threading.Thread(target=self.publish_roots, args=(nums,), daemon=True).start()
+
+    def publish_roots(self, nums):
+        records = []
+        for num in nums:
+            try:
+                root = self.manifests.get('%s/file%s.txt' % (self.DIR, num)).root
+            except OSError:
+                continue
+            records.append((num, self.file_title(num), root))
+        self.add_bulk(records)
+
+    # keep our lease on the server; it forgets peers that go quiet
+    def heartbeat(self):
+        interval = self.HEARTBEAT_INTERVAL
+        while True:
+            time.sleep(interval)
+            msg = 'HEARTBEAT %s\n' % self.V
+            msg += 'Host: %s\n' % socket.gethostname()
+            msg += 'Port: %s\n' % self.UPLOAD_PORT
+            try:
+                res = self.server.call(msg)
+                if res.start[1] == '404' and self.register:
+                    # our lease ran out, or the server restarted without us
+                    self.register_all()
+            except (ConnectionError, MyException):
+                return
+            lease = res.header('Lease')
+            if lease:
+                interval = min(self.HEARTBEAT_INTERVAL, float(lease) / 3)
+
+    # BULK_SIZE records per ADD BULK request, all batches pipelined
+    def add_bulk(self, records):
+        msg = 'ADD BULK %s\n' % self.V
+        msg += 'Host: %s\n' % socket.gethostname()
+        msg += 'Port: %s\n' % self.UPLOAD_PORT
+        batches = [(msg, ''.join('%s %s %s\n' % (num, root, title)
+                                 for num, title, root in records[i:i + self.BULK_SIZE]).encode())
+                   for i in range(0, len(records), self.BULK_SIZE)]
+        count = 0
+        for res in self.server.pipeline(batches):
+            if res.start[1] != '200':
+                raise MyException('Registration Failed.')
+            count += int(res.header('Count'))
+        return count
+
+    # the first line of the file stands in for its title
+    def file_title(self, num):
+        with open('%s/file%s.txt' % (self.DIR, num), 'rb') as file:
+            title = ' '.join(file.readline(200).decode(errors='replace').split())
+        return title or 'file%s' % num
 
     def lookup(self):
         print()
-        num = input('Enter the File number: ')
+        num = input('Enter the File number (leave empty to search by title): ')
         title = input('Enter the File title(optional): ')
+        if not num.strip():
+            self.search(title)
+            return
+        res = self.lookup_rfc(num, title)
+        print()
+        print('Receive response: \n%s' % res.text())
+
+        print()
+
+    # LOOKUP through the cache; only answers naming holders are kept
+    def lookup_rfc(self, num, title='Unknown'):
+        num = num.strip()
+        res = self.lookups.get(num)
+        if res is not None:
+            return res
         msg = 'LOOKUP RFC %s %s\n' % (num, self.V)
         msg += 'Host: %s\n' % socket.gethostname()
         msg += 'Port: %s\n' % self.UPLOAD_PORT
         msg += 'Title: %s\n' % title
-        self.server.sendall(msg.encode())
-        res = self.server.recv(1024).decode()
-        print()
-        print('Receive response: \n%s' % res)
+        res = self.server.call(msg)
+        if res.start[1] == '200':
+            self.lookups.put(num, res)
+        return res
 
+    def search(self, query):
+        msg = 'SEARCH RFC %s\n' % self.V
+        msg += 'Host: %s\n' % socket.gethostname()
+        msg += 'Port: %s\n' % self.UPLOAD_PORT
+        msg += 'Title: %s\n' % query
+        res = self.server.call(msg)
+        print()
+        print('Receive response: \n%s' % res.text())
         print()
 
     def listall(self):
-        l1 = 'LIST ALL %s\n' % self.V
-        l2 = 'Host: %s\n' % socket.gethostname()
-        l3 = 'Port: %s\n' % self.UPLOAD_PORT
-        msg = l1 + l2 + l3
-        self.server.sendall(msg.encode())
-        res = self.server.recv(1024).decode()
+        # page through the catalogue; the server sends the next cursor until the last page
+        cursor = 0
         print()
-        print('Receive response: \n%s' % res)
+        print('Receive response: ')
+        while cursor is not None:
+            l1 = 'LIST ALL %s %s %s\n' % (cursor, self.LIST_PAGE, self.V)
+            l2 = 'Host: %s\n' % socket.gethostname()
+            l3 = 'Port: %s\n' % self.UPLOAD_PORT
+            msg = l1 + l2 + l3
+            res = self.server.call(msg)
+            if cursor == 0:
+                print(res.lines[0])
+            for line in res.lines[1:]:
+                if line.startswith('RFC '):
+                    print(line)
+            cursor = res.header('Cursor')
 
     def pre_download(self):
         print()
-        num = input('Enter the File number: ')
-        msg = 'LOOKUP RFC %s %s\n' % (num, self.V)
-        msg += 'Host: %s\n' % socket.gethostname()
-        msg += 'Port: %s\n' % self.UPLOAD_PORT
-        msg += 'Title: Unknown\n'
-        
-        self.server.sendall(msg.encode())
-        lines = self.server.recv(1024).decode().splitlines()
+        num = input('Enter the File number: ').strip()
+        res = self.lookup_rfc(num)
+        root = res.header('Root')
+        lines = res.lines[:1] + [line for line in res.lines[1:] if line.startswith('RFC ')]
 
         print()
         if lines[0].split()[1] == '200':
             # Choose a peer
-            print('Available peers: ')
+            me = (socket.gethostname(), self.UPLOAD_PORT)
+            print('Available peers, best first: ')
             for i, line in enumerate(lines[1:]):
                 line = line.split()
                 print('%s: %s:%s' % (i + 1, line[-2], line[-1]))
 
             try:
-                idx = int(input('\nChoose one peer to download: '))
-                title = lines[idx].rsplit(None, 2)[0].split(None, 2)[-1]
-                peer_host = lines[idx].split()[-2]
-                peer_port = int(lines[idx].split()[-1])
+                if self.auto_select:
+                    # the server lists the peers that served downloads best first
+                    idx = next(i + 1 for i, line in enumerate(lines[1:])
+                               if (line.split()[-2], int(line.split()[-1])) != me)
+                    print('\nDownloading from peer %s' % idx)
+                else:
+                    idx = int(input('\nChoose one peer to download (0 for all peers): '))
+                title = lines[idx or 1].rsplit(None, 2)[0].split(None, 2)[-1]
+                peer_host = lines[idx or 1].split()[-2]
+                peer_port = int(lines[idx or 1].split()[-1])
             except Exception:
                 raise MyException('Invalid Input.')
+            if idx == 0:
+                peers = [(line.split()[-2], int(line.split()[-1])) for line in lines[1:]]
+                try:
+                    self.swarm_download(num, title, [peer for peer in peers if peer != me], root)
+                except MyException:
+                    # the holders we were given may be stale; ask the server next time
+                    self.lookups.invalidate(num)
+                    raise
+                return
             # exclude self
-            if((peer_host, peer_port) == (socket.gethostname(), self.UPLOAD_PORT)):
+            if (peer_host, peer_port) == me:
                 raise MyException('Do not choose yourself.\n\n----------------------------------------------------------')
             
             # send get request
-            self.download(num, title, peer_host, peer_port)
+            try:
+                self.download(num, title, peer_host, peer_port, root)
+            except MyException:
+                self.lookups.invalidate(num)
+                raise
         elif lines[0].split()[1] == '400':
             raise MyException('Invalid Input.')
         elif lines[0].split()[1] == '404':
+            if input('File Not Available. Notify me when it is shared? (y/n): ').strip().lower() == 'y':
+                self.watch(num)
+                return
             raise MyException('File Not Available.')
         elif lines[0].split()[1] == '500':
             raise MyException('Version Not Supported.')
 
-    def download(self, num, title, peer_host, peer_port):
-        try:
-            # make connection
-            soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # connect_ex return errors
-            if soc.connect_ex((peer_host, peer_port)):
-                raise MyException('Peer Not Available')
-            # make request
-            msg = 'GET RFC %s %s\n' % (num, self.V)
-            msg += 'Host: %s\n' % socket.gethostname()
-            msg += 'OS: %s\n' % platform.platform()
-            soc.sendall(msg.encode())
+    # ask the server to push changes to these RFCs instead of polling LOOKUP
+    def watch(self, *nums):
+        msg = 'WATCH RFC %s %s\n' % (' '.join(str(num) for num in nums), self.V)
+        msg += 'Host: %s\n' % socket.gethostname()
+        msg += 'Port: %s\n' % self.UPLOAD_PORT
+        res = self.server.call(msg)
+        if res.start[1] != '200':
+            raise MyException('Watch Failed.')
+        print('Watching %s files.' % res.header('Watching'))
 
+    def unwatch(self, *nums):
+        msg = 'UNWATCH RFC %s %s\n' % (' '.join(str(num) for num in nums), self.V)
+        msg += 'Host: %s\n' % socket.gethostname()
+        msg += 'Port: %s\n' % self.UPLOAD_PORT
+        self.server.call(msg)
+
+    # NOTIFY pushed by the server for a watched RFC; runs on the connection's reader thread
+    def notified(self, msg):
+        num = msg.start[2]
+        event = msg.header('Event')
+        if event == 'overflow':
+            # notifications were dropped; nothing cached can be trusted
+            self.lookups.clear()
+            return
+        self.lookups.invalidate(num)
+        if event == 'added':
+            print('\nFile %s is now shared by %s:%s' % (num, msg.header('Host'), msg.header('Port')))
+        elif event == 'removed' and msg.header('Holders') == '0':
+            print('\nFile %s is no longer shared by anyone' % num)
+
+    # the manifest matching the root the server published, checked chunk by chunk
+    def verifier(self, num, peers, root):
+        if not root:
+            return Verifier()
+        manifest = fetch_manifest(self.V, num, peers, root, self.pool)
+        if manifest is None:
+            raise MyException('No peer serves a manifest matching the published root.')
+        return Verifier(manifest)
+
+    # fetch pieces from all peers at once
+    def swarm_download(self, num, title, peers, root=None):
+        if not peers:
+            raise MyException('No Other Peer Available.')
+        verifier = self.verifier(num, peers, root)
+        chunk_size = verifier.manifest.chunk_size if verifier.manifest else None
+        partial = PartialDownload('%s/file%s.txt' % (self.DIR, num), chunk_size, root)
+        print('Downloading from %s peers...' % len(peers))
+        swarm = Swarm(self.V, num, peers, partial, verifier, self.pool)
+        try:
+            swarm.run()
+        except SwarmError as e:
+            raise MyException('Downloading Failed: %s' % e)
+        finally:
+            verifier.close()
+            self.report(num, swarm.transfers())
+        partial.finish()
+        print('Downloading Completed.')
+        # Share file, send ADD request
+        print('Sending upload request to share...')
+        if self.shareable:
+            self.add(num, title)
+
+    def download(self, num, title, peer_host, peer_port, root=None):
+        verifier = self.verifier(num, [(peer_host, peer_port)], root)
+        chunk_size = verifier.manifest.chunk_size if verifier.manifest else None
+        # resume from the first missing piece of an earlier attempt, from any peer
+        partial = PartialDownload('%s/file%s.txt' % (self.DIR, num), chunk_size, root)
+        peer = (peer_host, peer_port)
+        try:
+            if not partial.complete():
+                began = time.monotonic()
+                try:
+                    size = self.get_file(num, partial, peer_host, peer_port, verifier)
+                except MyException:
+                    self.report(num, [(peer, 0, 0, 1)])
+                    raise
+                self.report(num, [(peer, size, time.monotonic() - began, 0)])
+            if not partial.complete():
+                # fetch the chunks that failed verification again, one by one
+                swarm = Swarm(self.V, num, [peer], partial, verifier, self.pool)
+                try:
+                    swarm.run()
+                finally:
+                    self.report(num, swarm.transfers())
+        except SwarmError:
+            raise MyException('Downloading Failed: Corrupt Data')
+        finally:
+            verifier.close()
+        partial.finish()
+
+        print('Downloading Completed.')
+        # Share file, send ADD request
+        print('Sending upload request to share...')
+        if self.shareable:
+            self.add(num, title)
+
+    def get_file(self, num, partial, peer_host, peer_port, verifier):
+        offset = partial.first_missing()
+        peer = (peer_host, peer_port)
+        # make request
+        msg = 'GET RFC %s %s\n' % (num, self.V)
+        msg += 'Host: %s\n' % socket.gethostname()
+        msg += 'OS: %s\n' % platform.platform()
+        if offset:
+            msg += 'Range: bytes=%s-\n' % offset
+        else:
+            msg += 'Accept-Encoding: %s\n' % accept_encoding()
+        try:
+            # a pooled connection if we have one to this peer
+            soc, reader, res = self.pool.request(peer, msg)
+        except OSError:
+            raise MyException('Peer Not Available')
+        finished = False
+        try:
             # Downloading
-            header = soc.recv(1024).decode()
-            print('Receive response header: \n%s' % header)
-            header = header.splitlines()
-            if header[0].split()[-2] == '200':
-                path = '%s/file%s.txt' % (self.DIR, num)
+            print('Receive response header: \n%s' % res.text())
+            header = res.lines
+            if header[0].split()[1] == '206':
+                if int(res.header('Content-Range').rsplit('/', 1)[1]) != partial.size:
+                    # the peer's copy differs from the one we started on
+                    soc.close()
+                    partial.reset()
+                    return self.get_file(num, partial, peer_host, peer_port, verifier)
+                print('Resuming at byte %s...' % offset)
+            elif header[0].split()[-2] == '200':
+                offset = 0
+                partial.start(int(res.header('Decoded-Length', res.length)))
                 print('Downloading...')
-                try:
-                    with open(path, 'w') as file:
-                        content = soc.recv(1024)
-                        while content:
-                            file.write(content.decode())
-                            content = soc.recv(1024)
-                except Exception:
-                    raise MyException('Downloading Failed')
-
-                total_length = int(header[4].split()[1])
-                if os.path.getsize(path) < total_length:
-                    raise MyException('Downloading Failed')
-
-                print('Downloading Completed.')
-                # Share file, send ADD request
-                print('Sending upload request to share...')
-                if self.shareable:
-                    self.add(num, title)
             elif header[0].split()[1] == '400':
                 raise MyException('Invalid Input.')
             elif header[0].split()[1] == '404':
                 raise MyException('File Not Available.')
+            elif header[0].split()[1] == '503':
+                raise MyException('Peer Busy, Try Again In %s Seconds.' % res.header('Retry-After'))
             elif header[0].split()[1] == '500':
                 raise MyException('Version Not Supported.')
+            else:
+                raise MyException('Downloading Failed')
+            if (res.header('Transfer-Encoding') or '').lower() == 'chunked':
+                chunks = reader.iter_chunks()
+            else:
+                chunks = reader.iter_body(res.length)
+            if res.header('Content-Encoding'):
+                print('Receiving %s-encoded...' % res.header('Content-Encoding'))
+                chunks = decompress(res.header('Content-Encoding'), chunks)
+            try:
+                bad = receive(partial, offset, chunks, verifier)
+            except Exception:
+                raise MyException('Downloading Failed')
+            finally:
+                partial.save(True)
+            finished = True
+
+            if bad:
+                print('%s chunks failed verification.' % len(bad))
+            elif not partial.complete():
+                raise MyException('Downloading Failed')
+            return partial.size - offset
         finally:
-            soc.close()
+            if finished:
+                self.pool.release(peer, soc, reader)
+            else:
+                soc.close()
+
+    # tell the server how the peers we downloaded from did, so LOOKUP ranks them
+    def report(self, num, transfers):
+        if not transfers:
+            return
+        msg = 'REPORT RFC %s %s\n' % (num, self.V)
+        msg += 'Host: %s\n' % socket.gethostname()
+        msg += 'Port: %s\n' % self.UPLOAD_PORT
+        body = ''.join('%s %s %s %.3f %s\n' % (peer[0], peer[1], size, seconds, failures)
+                       for peer, size, seconds, failures in transfers)
+        self.server.request(msg, body.encode())  # nobody waits for the answer
 
     def invalid_input(self):
         raise MyException('Invalid Input.')
@@ -332,6 +689,13 @@ class Client(object):
         print("\n----------------------------------------------------------")
         print('                   Shutting Down...                        ')
         print("----------------------------------------------------------")
+        stats = self.lookups.stats()
+        print('Lookup cache: %(hits)s hits, %(misses)s misses (%(hit_rate).0f%%), '
+              '%(expired)s expired, %(evicted)s evicted, %(invalidated)s invalidated'
+              % dict(stats, hit_rate=100 * stats['hit_rate']))
+        stats = self.uploads.stats()
+        print('Uploads: %(served)s served, %(rejected)s turned away busy, %(sent)s bytes sent' % stats)
+        logs.stop()  # os._exit skips atexit, and would drop the queued log records
         try:
             sys.exit(0)
         except SystemExit:
@@ -339,8 +703,24 @@ class Client(object):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) == 2:
-        client = Client(sys.argv[1])
-    else:
-        client = Client()
+    parser = argparse.ArgumentParser(description='P2P-CI peer')
+    parser.add_argument('serverhost', nargs='?', default='localhost')
+    parser.add_argument('--no-register', dest='register', action='store_false',
+                        help='do not share the files already in SHARED_FILES at startup')
+    parser.add_argument('--auto-select', action='store_true', default=None,
+                        help='download from the best ranked peer without asking (default when stdin is not a terminal)')
+    parser.add_argument('--compress-cache', type=float, default=CompressedCache.MAX_BYTES >> 20,
+                        help='MiB of compressed copies of shared files kept for uploads; 0 to compress every time')
+    parser.add_argument('--upload-slots', type=int, default=Client.UPLOAD_SLOTS,
+                        help='files uploaded at once; further downloaders wait in line')
+    parser.add_argument('--upload-rate', type=float, default=0,
+                        help='KiB/s for all uploads together, shared evenly; 0 for no limit')
+    parser.add_argument('--log-level', choices=logs.LEVELS, default='WARNING',
+                        help='INFO logs every upload')
+    parser.add_argument('--log-file', help='write the log here rather than to stderr')
+    args = parser.parse_args()
+    logs.setup(args.log_level, path=args.log_file)
+    client = Client(args.serverhost, register=args.register, upload_slots=args.upload_slots,
+                    upload_rate=int(args.upload_rate * 1024), auto_select=args.auto_select,
+                    compress_cache=int(args.compress_cache * (1 << 20)))
     client.start()
\ No newline at end of file
@@ -0,0 +1,217 @@
+import collections
+import lzma
+import os
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional; zlib and lzma are always there
+    zstandard = None
+
+BLOCK = 1 << 16  # bytes read from the file per compress call
+MIN_SIZE = 1024  # smaller files are not worth compressing
+SAMPLE = 1 << 18  # bytes compressed to judge whether a whole file is worth it
+MAX_RATIO = 0.9  # files whose sample compresses worse than this are sent as they are
+
+
+def _zstd_compressor():
+    return zstandard.ZstdCompressor(level=3).compressobj()
+
+
+def _zstd_decompressor():
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+# name -> (compressor factory, decompressor factory); objects with compress()/flush() and decompress()
+CODECS = {
+    'zlib': (lambda: zlib.compressobj(6), zlib.decompressobj),
+    'lzma': (lzma.LZMACompressor, lzma.LZMADecompressor),
+}
+if zstandard is not None:
+    CODECS['zstd'] = (_zstd_compressor, _zstd_decompressor)
+
+# what we ask for, best first: zstd is both fast and small, lzma small but slow
+PREFERENCE = [name for name in ('zstd', 'zlib', 'lzma') if name in CODECS]
+
+
+def accept_encoding():
+    return ', '.join(PREFERENCE)
+
+
+def negotiate(accept):
+    """The first encoding in an Accept-Encoding value that we support, or None for identity."""
+    for name in (accept or '').split(','):
+        name = name.split(';')[0].strip().lower()
+        if name in CODECS:
+            return name
+    return None
+
+
+def compress_stream(file, encoding):
+    """Yield the encoded contents of file as it is compressed, a block at a time."""
+    compressor = CODECS[encoding][0]()
+    file.seek(0)
+    while True:
+        data = file.read(BLOCK)
+        if not data:
+            break
+        data = compressor.compress(data)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compressible(file, encoding):
+    """Whether the first SAMPLE bytes of file shrink to under MAX_RATIO of their size."""
+    file.seek(0)
+    sample = file.read(SAMPLE)
+    compressor = CODECS[encoding][0]()
+    size = len(compressor.compress(sample)) + len(compressor.flush())
+    return size < len(sample) * MAX_RATIO
+
+
+def decompress(encoding, chunks):
+    """Decode an encoded body as it arrives, chunk by chunk."""
+    decompressor = CODECS[encoding][1]()
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    rest = getattr(decompressor, 'flush', None)
+    if rest is not None:
+        data = rest()
+        if data:
+            yield data
+
+
+class CompressedCache(object):
+    """Compressed copies of shared files, kept on disk between uploads.
+
+    The first upload of a file streams its compressed bytes as they are
+    made and writes them here as it goes; later uploads send the copy.
+    A copy is named after the file's size and mtime, so an edited file
+    is compressed afresh and its stale copies are removed. At most
+    max_bytes of copies are kept, the least recently sent going first.
+    With max_bytes 0 nothing is kept and every upload compresses.
+    Files found not worth compressing are remembered under the same
+    names, kept or not, so each version of a file is sampled once.
+    """
+    MAX_BYTES = 256 << 20
+    MAX_INCOMPRESSIBLE = 4096  # names of files not worth compressing remembered
+
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.building = set()  # names of copies an upload is writing
+        self.entries = collections.OrderedDict()  # name -> size, least recently used first
+        self.size = 0
+        self.incompressible = collections.OrderedDict()  # name -> None, least recently used first
+        if max_bytes:
+            os.makedirs(directory, exist_ok=True)
+            for name in os.listdir(directory):
+                if name.endswith('.tmp'):  # left by an upload cut short
+                    os.remove(os.path.join(directory, name))
+            names = os.listdir(directory)
+            for name in sorted(names, key=lambda name: os.path.getatime(os.path.join(directory, name))):
+                self.entries[name] = os.path.getsize(os.path.join(directory, name))
+                self.size += self.entries[name]
+
+    def name(self, path, file, encoding):
+        stat = os.fstat(file.fileno())
+        return '%s.%s.%s.%s' % (os.path.basename(path), stat.st_size, stat.st_mtime_ns, encoding)
+
+    def compressible(self, path, file, encoding):
+        """Whether path, read from file, is worth compressing, as compressible() judges it."""
+        name = self.name(path, file, encoding)
+        with self.lock:
+            if name in self.incompressible:
+                self.incompressible.move_to_end(name)
+                return False
+        if compressible(file, encoding):
+            return True
+        with self.lock:
+            self.incompressible[name] = None
+            if len(self.incompressible) > self.MAX_INCOMPRESSIBLE:
+                self.incompressible.popitem(last=False)
+        return False
+
+    def open(self, path, file, encoding):
+        """An open binary file of the kept copy of path, read from file; None if there is none yet."""
+        if not self.max_bytes:
+            return None
+        name = self.name(path, file, encoding)
+        with self.lock:
+            if name not in self.entries:
+                return None
+            self.entries.move_to_end(name)
+            try:
+                return open(os.path.join(self.directory, name), 'rb')
+            except OSError:
+                self.size -= self.entries.pop(name)
+                return None
+
+    def stream(self, path, file, encoding):
+        """Yield the encoded contents of path as compress_stream does, keeping a copy.
+
+        The copy is kept only if the stream is read to the end, it fits
+        in max_bytes, and no other upload is already writing it.
+        """
+        name = self.name(path, file, encoding)
+        with self.lock:
+            keep = self.max_bytes and name not in self.building
+            if keep:
+                self.building.add(name)
+        if not keep:
+            yield from compress_stream(file, encoding)
+            return
+        target = os.path.join(self.directory, name)
+        out = open(target + '.tmp', 'wb')
+        size = 0
+        try:
+            for data in compress_stream(file, encoding):
+                if out is not None:
+                    size += len(data)
+                    if size > self.max_bytes:
+                        out.close()
+                        os.remove(target + '.tmp')
+                        out = None
+                    else:
+                        out.write(data)
+                yield data
+            if out is not None:
+                out.close()
+                os.replace(target + '.tmp', target)
+                self.add(name, size)
+                out = None
+        finally:
+            if out is not None:  # the downloader went away
+                out.close()
+                os.remove(target + '.tmp')
+            with self.lock:
+                self.building.discard(name)
+
+    # keep a copy just written, making room for it
+    def add(self, name, size):
+        base, encoding = name.rsplit('.', 3)[0], name.rsplit('.', 1)[1]
+        with self.lock:
+            self.entries[name] = size
+            self.size += size
+            # older versions of the same file will not be asked for again
+            stale = [other for other in self.entries
+                     if other != name and other.startswith(base + '.') and other.endswith('.' + encoding)]
+            excess = self.size - sum(self.entries[other] for other in stale) - self.max_bytes
+            for other in self.entries:
+                if excess <= 0:
+                    break
+                if other != name and other not in stale:
+                    stale.append(other)
+                    excess -= self.entries[other]
+            for other in stale:
+                self.size -= self.entries.pop(other)
+        for other in stale:
+            try:
+                os.remove(os.path.join(self.directory, other))
+            except OSError:
+                pass
@@ -0,0 +1,153 @@
+import bisect
+import threading
+
+
+class RfcIndex(object):
+    """Which peers hold which RFCs, safe to share between handler threads.
+
+    rfcs maps an RFC number to an immutable (title, frozenset of peers,
+    Merkle root or None) entry. Writers replace the whole entry (copy-on-write), so LOOKUPs
+    read it without taking any lock. Writers lock only the stripe that
+    owns the RFC number, plus the stripe owning the peer, always in the
+    order peer stripe -> RFC stripe -> order lock.
+    """
+
+    def __init__(self, stripes=64, titles=None, lock=threading.Lock):
+        self.rfcs = {}
+        self.titles = titles  # optional search.TitleIndex kept in step with the RFCs
+        self.peers = {}  # peer -> set of RFC numbers
+        self.order = []  # sorted RFC numbers, for paging through LIST
+        # lock makes every lock, e.g. metrics.TimedLock to measure contention
+        self.rfc_locks = [lock() for _ in range(stripes)]
+        self.peer_locks = [lock() for _ in range(stripes)]
+        self.order_lock = lock()
+
+    def rfc_stripe(self, num):
+        return hash(num) % len(self.rfc_locks)
+
+    def rfc_lock(self, num):
+        return self.rfc_locks[self.rfc_stripe(num)]
+
+    def peer_lock(self, peer):
+        return self.peer_locks[hash(peer) % len(self.peer_locks)]
+
+    def __len__(self):
+        return len(self.rfcs)
+
+    # lock-free read; returns (title, frozenset of peers, root) or None
+    def get(self, num):
+        return self.rfcs.get(num)
+
+    def add(self, peer, num, title, root=None):
+        with self.peer_lock(peer):
+            self.peers.setdefault(peer, set()).add(num)
+            with self.rfc_lock(num):
+                entry, created = self._add(peer, num, title, root)
+                if created:
+                    with self.order_lock:
+                        bisect.insort(self.order, num)
+        return entry
+
+    def add_many(self, peer, records):
+        """Add (num, title, root) records for peer as one transaction; returns [(num, entry)]."""
+        locks = sorted(set(self.rfc_stripe(record[0]) for record in records))
+        entries = []
+        created = []
+        with self.peer_lock(peer):
+            for i in locks:
+                self.rfc_locks[i].acquire()
+            try:
+                self.peers.setdefault(peer, set()).update(record[0] for record in records)
+                for num, title, root in records:
+                    entry, new = self._add(peer, num, title, root)
+                    entries.append((num, entry))
+                    if new:
+                        created.append(num)
+                with self.order_lock:
+                    if len(created) > 32:
+                        # timsort merges the two sorted runs in linear time
+                        self.order.extend(sorted(created))
+                        self.order.sort()
+                    else:
+                        for num in created:
+                            bisect.insort(self.order, num)
+            finally:
+                for i in reversed(locks):
+                    self.rfc_locks[i].release()
+        return entries
+
+    # caller holds the RFC stripe lock; returns (entry, whether the RFC is new)
+    def _add(self, peer, num, title, root):
+        entry = self.rfcs.get(num)
+        if entry is None:
+            entry = self.rfcs[num] = (title, frozenset([peer]), root)
+            if self.titles is not None:
+                self.titles.add(num, title)
+            return entry, True
+        # the first published root sticks; holders of other content fail verification
+        if peer not in entry[1] or (entry[2] is None and root):
+            entry = self.rfcs[num] = (entry[0], entry[1] | {peer}, entry[2] or root)
+        return entry, False
+
+    def remove_peer(self, peer):
+        """Drop every record of peer; returns (its RFC numbers, RFCs left with no holder)."""
+        emptied = []
+        with self.peer_lock(peer):
+            nums = self.peers.pop(peer, set())
+            locks = sorted(set(self.rfc_stripe(num) for num in nums))
+            for i in locks:
+                self.rfc_locks[i].acquire()
+            try:
+                for num in nums:
+                    entry = self.rfcs.get(num)
+                    if entry is None or peer not in entry[1]:
+                        continue
+                    holders = entry[1] - {peer}
+                    if holders:
+                        self.rfcs[num] = (entry[0], holders, entry[2])
+                        continue
+                    del self.rfcs[num]
+                    emptied.append(num)
+                    if self.titles is not None:
+                        self.titles.remove(num, entry[0])
+                with self.order_lock:
+                    if len(emptied) > 32:
+                        # one linear pass instead of a list deletion per RFC
+                        gone = set(emptied)
+                        self.order = [num for num in self.order if num not in gone]
+                    else:
+                        for num in emptied:
+                            i = bisect.bisect_left(self.order, num)
+                            if i < len(self.order) and self.order[i] == num:
+                                del self.order[i]
+            finally:
+                for i in reversed(locks):
+                    self.rfc_locks[i].release()
+        return nums, emptied
+
+    def entries(self):
+        """Copy of every entry, for snapshots; copying a dict is atomic under the GIL."""
+        return dict(self.rfcs)
+
+    def restore(self, rfcs, peers):
+        """Replace the whole index with state loaded from disk, before serving starts."""
+        self.rfcs = rfcs
+        self.peers = peers
+        self.order = sorted(rfcs)
+        if self.titles is not None:
+            # words of a million titles take seconds to index; serve meanwhile
+            items = [(num, entry[0]) for num, entry in rfcs.items()]
+            threading.Thread(target=self.titles.build, args=(items,), daemon=True).start()
+
+    def page(self, cursor, limit):
+        """Copy up to limit RFCs numbered cursor or above; returns (records, next cursor)."""
+        with self.order_lock:
+            i = bisect.bisect_left(self.order, cursor)
+            nums = self.order[i:i + limit]
+            more = self.order[i + limit] if i + limit < len(self.order) else None
+        records = []
+        for num in nums:
+            entry = self.rfcs.get(num)
+            if entry is not None:
+                records.append((num, entry[0], entry[1]))
+        return records, more
@@ -0,0 +1,46 @@
+import heapq
+import threading
+import time
+
+
+class LeaseTable(object):
+    """When each peer was last heard from, ordered by deadline.
+
+    renew() pushes a fresh (deadline, peer) entry onto a heap and records
+    the deadline in a dict; older heap entries for the peer are left in
+    place and skipped when they surface (lazy deletion). expired() pops
+    only the entries that are due, so evicting k stale peers costs
+    O(k log n) however large the index is.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.deadlines = {}  # peer -> deadline
+        self.heap = []
+
+    def renew(self, peer, ttl):
+        deadline = self.clock() + ttl
+        with self.lock:
+            self.deadlines[peer] = deadline
+            heapq.heappush(self.heap, (deadline, peer))
+
+    def alive(self, peer):
+        deadline = self.deadlines.get(peer)
+        return deadline is not None and deadline > self.clock()
+
+    def drop(self, peer):
+        with self.lock:
+            self.deadlines.pop(peer, None)
+
+    def expired(self):
+        """Remove and return every peer whose lease has run out."""
+        now = self.clock()
+        peers = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, peer = heapq.heappop(self.heap)
+                if self.deadlines.get(peer) == deadline:
+                    del self.deadlines[peer]
+                    peers.append(peer)
+        return peers
@@ -0,0 +1,107 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+QUEUE_SIZE = 10000  # records waiting for the writer thread; more are dropped
+
+listeners = []  # writer threads started by setup()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread and never waits: a full queue drops them, counted."""
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        return record  # formatted by the writer thread, not the one that logged it
+
+
+class Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)  # waits for room, behind every queued record
+
+
+class EventFormatter(logging.Formatter):
+    """'<time> <level> <event> key=value ...', or one JSON object per line."""
+
+    def __init__(self, json_lines=False):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        if self.json_lines:
+            event = {'time': round(record.created, 6), 'level': record.levelname, 'logger': record.name,
+                     'event': record.getMessage()}
+            event.update(fields)
+            if record.exc_info:
+                event['exc'] = self.formatException(record.exc_info)
+            return json.dumps(event, default=str)
+        line = '%s.%03d %-7s %s' % (time.strftime('%H:%M:%S', time.localtime(record.created)),
+                                    record.msecs, record.levelname, record.getMessage())
+        for key, value in fields.items():
+            value = str(value)
+            if not value or any(c in value for c in ' ="\n'):
+                value = json.dumps(value)
+            line += ' %s=%s' % (key, value)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+def setup(level='INFO', json_lines=False, path=None, stream=None):
+    """Send the 'p2p' loggers' records through a queue to a writer thread.
+
+    The thread writes to path, or to stream (stderr by default), so a
+    thread that logs never waits for a terminal or a disk.
+    """
+    target = logging.FileHandler(path) if path else logging.StreamHandler(stream or sys.stderr)
+    target.setFormatter(EventFormatter(json_lines))
+    records = queue.Queue(QUEUE_SIZE)
+    handler = DroppingQueueHandler(records)
+    listener = Listener(records, target)
+    listener.start()
+    listeners.append(listener)
+    atexit.register(stop)  # only on a normal exit; callers of os._exit call stop() first
+    root = logging.getLogger('p2p')
+    root.handlers = [handler]
+    root.setLevel(level)
+    root.propagate = False
+    return handler
+
+
+def stop():
+    """Write out every queued record and stop the writer threads; safe to call more than once."""
+    while listeners:
+        listeners.pop().stop()
+
+
+def event(logger, level, name, **fields):
+    """Log the event name with fields as structured key/values."""
+    if logger.isEnabledFor(level):
+        logger.log(level, name, extra={'fields': fields})
+
+
+class Sampler(object):
+    """True for about rate of the calls; for logging bodies of some requests but not all."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.random = random.Random()
+
+    def __call__(self):
+        return self.rate >= 1 or (self.rate > 0 and self.random.random() < self.rate)
@@ -0,0 +1,66 @@
+import collections
+import threading
+import time
+
+
+class LookupCache(object):
+    """Recent LOOKUP responses, by RFC number.
+
+    Entries live for ttl seconds and at most capacity of them are kept,
+    the least recently used going first. The counters show how well the
+    cache is doing: a hit rate that stays low means ttl is too short or
+    capacity too small for the RFCs being looked up.
+    """
+
+    def __init__(self, capacity=1024, ttl=30, clock=time.monotonic):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # num -> (expiry, response)
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.invalidated = 0
+
+    def get(self, num):
+        with self.lock:
+            entry = self.entries.get(num)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= self.clock():
+                del self.entries[num]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(num)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, num, response):
+        with self.lock:
+            self.entries[num] = (self.clock() + self.ttl, response)
+            self.entries.move_to_end(num)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+
+    def invalidate(self, num):
+        with self.lock:
+            if self.entries.pop(num, None) is not None:
+                self.invalidated += 1
+
+    def clear(self):
+        with self.lock:
+            self.invalidated += len(self.entries)
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'expired': self.expired, 'evicted': self.evicted,
+                    'invalidated': self.invalidated}
@@ -0,0 +1,163 @@
+import hashlib
+import os
+import platform
+import socket
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from pool import PeerPool
+
+CHUNK_SIZE = 1 << 20  # same as a download piece, so every piece is checked on its own
+
+
+def leaf_hash(data):
+    return hashlib.sha256(b'\x00' + data).digest()
+
+
+def merkle_root(hashes):
+    """Root of the binary tree over the leaf hashes; an odd node is carried up as is."""
+    level = list(hashes)
+    while len(level) > 1:
+        nxt = [hashlib.sha256(b'\x01' + level[i] + level[i + 1]).digest()
+               for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            nxt.append(level[-1])
+        level = nxt
+    return level[0].hex()
+
+
+class Manifest(object):
+    """Hash of every chunk of a file, plus the Merkle root over them."""
+
+    def __init__(self, size, chunk_size, hashes):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.hashes = hashes
+        self.root = merkle_root(hashes)
+
+    @classmethod
+    def of_file(cls, path, chunk_size=CHUNK_SIZE):
+        hashes = []
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            chunk = file.read(chunk_size)
+            hashes.append(leaf_hash(chunk))
+            while len(chunk) == chunk_size:
+                chunk = file.read(chunk_size)
+                if chunk:
+                    hashes.append(leaf_hash(chunk))
+        return cls(size, chunk_size, hashes)
+
+    @classmethod
+    def parse(cls, size, chunk_size, body):
+        return cls(size, chunk_size, [bytes.fromhex(line) for line in body.decode().split()])
+
+    def text(self):
+        return ''.join(digest.hex() + '\n' for digest in self.hashes)
+
+    def verify(self, chunk, data):
+        return chunk < len(self.hashes) and leaf_hash(data) == self.hashes[chunk]
+
+
+class ManifestCache(object):
+    """Manifests of shared files, rebuilt only when a file's size or mtime changes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.manifests = {}  # path -> ((size, mtime), manifest)
+
+    def get(self, path):
+        stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            cached = self.manifests.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        manifest = Manifest.of_file(path)
+        with self.lock:
+            self.manifests[path] = (key, manifest)
+        return manifest
+
+
+def fetch_manifest(V, num, peers, root, pool=None):
+    """Ask peers in turn for the manifest of RFC num; returns the first one whose root matches, or None."""
+    own = pool is None
+    pool = pool or PeerPool()
+    msg = 'MANIFEST RFC %s %s\n' % (num, V)
+    msg += 'Host: %s\n' % socket.gethostname()
+    msg += 'OS: %s\n' % platform.platform()
+    try:
+        for peer in peers:
+            try:
+                soc, reader, res = pool.request(peer, msg)
+            except OSError:
+                continue
+            try:
+                res.body = reader.read_exact(res.length)
+            except OSError:
+                soc.close()
+                continue
+            pool.release(peer, soc, reader)
+            if res.start[1] != '200':
+                continue
+            try:
+                manifest = Manifest.parse(int(res.header('Size')), int(res.header('Chunk-Size')), res.body)
+            except (ValueError, TypeError):
+                continue
+            if manifest.root == root:
+                return manifest
+        return None
+    finally:
+        if own:
+            pool.close()
+
+
+class Verifier(object):
+    """Checks downloaded pieces against a manifest on a small thread pool.
+
+    The network threads hand a piece over and go back to receiving;
+    callback(piece, data, ok) runs once the hash is known. At most
+    backlog pieces wait for hashing, which bounds the memory held.
+    Without a manifest every piece is accepted straight away.
+    """
+
+    def __init__(self, manifest=None, workers=2, backlog=8):
+        self.manifest = manifest
+        self.pool = ThreadPoolExecutor(workers) if manifest else None
+        self.slots = threading.BoundedSemaphore(backlog)
+        self.idle = threading.Condition()
+        self.outstanding = 0
+
+    def submit(self, piece, data, callback):
+        if self.manifest is None:
+            callback(piece, data, True)
+            return
+        self.slots.acquire()
+        with self.idle:
+            self.outstanding += 1
+
+        def done(future):
+            try:
+                callback(piece, data, future.exception() is None and future.result())
+            finally:
+                self.slots.release()
+                with self.idle:
+                    self.outstanding -= 1
+                    self.idle.notify_all()
+
+        try:
+            future = self.pool.submit(self.manifest.verify, piece, data)
+        except RuntimeError:
+            # pool already shut down
+            future = Future()
+            future.set_exception(RuntimeError('Verifier Closed'))
+        future.add_done_callback(done)
+
+    def wait(self):
+        with self.idle:
+            while self.outstanding:
+                self.idle.wait()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
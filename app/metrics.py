@@ -0,0 +1,153 @@
+import bisect
+import http.server
+import threading
+import time
+
+
+class Counter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram(object):
+    """Counts of observations per bucket, with their sum, in seconds by default."""
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+               0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        running = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            running += count
+            yield name + '_bucket', labels + (('le', str(bound)),), running
+        yield name + '_sum', labels, total
+        yield name + '_count', labels, running
+
+
+class Gauge(object):
+    """A value read when the metrics are rendered."""
+
+    def __init__(self, read):
+        self.read = read
+
+    def samples(self, name, labels):
+        yield name, labels, self.read()
+
+
+class Registry(object):
+    """Named metrics, rendered in the Prometheus text format.
+
+    Metrics are created on first use and found again by name and labels,
+    so instrumented code just asks for counter('x', verb='ADD') each time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}  # name -> (type, help, {labels: metric})
+
+    def get(self, kind, cls, name, help, labels, *args):
+        labels = tuple(sorted(labels.items()))
+        family = self.metrics.get(name)
+        if family is not None:
+            metric = family[2].get(labels)
+            if metric is not None:
+                return metric
+        with self.lock:
+            family = self.metrics.setdefault(name, (kind, help, {}))
+            return family[2].setdefault(labels, cls(*args))
+
+    def counter(self, name, help='', **labels):
+        return self.get('counter', Counter, name, help, labels)
+
+    def histogram(self, name, help='', **labels):
+        return self.get('histogram', Histogram, name, help, labels)
+
+    def gauge(self, name, read, help='', **labels):
+        return self.get('gauge', Gauge, name, help, labels, read)
+
+    def render(self):
+        with self.lock:
+            families = sorted((name, kind, help, list(metrics.items()))
+                              for name, (kind, help, metrics) in self.metrics.items())
+        lines = []
+        for name, kind, help, metrics in families:
+            if help:
+                lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, metric in metrics:
+                for sample, sample_labels, value in metric.samples(name, labels):
+                    if sample_labels:
+                        sample += '{%s}' % ','.join('%s="%s"' % label for label in sample_labels)
+                    lines.append('%s %s' % (sample, value))
+        return '\n'.join(lines) + '\n'
+
+
+class TimedLock(object):
+    """A Lock that records how long acquirers waited for it, when they had to."""
+
+    def __init__(self, waits):
+        self.lock = threading.Lock()
+        self.waits = waits  # Histogram
+
+    def acquire(self):
+        if self.lock.acquire(False):
+            return True
+        began = time.perf_counter()
+        self.lock.acquire()
+        self.waits.observe(time.perf_counter() - began)
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+
+def serve_http(registry, host, port):
+    """Serve registry.render() to scrapers at http://host:port/metrics from a thread of its own."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
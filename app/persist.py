@@ -0,0 +1,180 @@
+import array
+import gc
+import json
+import os
+import pickle
+import threading
+
+
+class Journal(object):
+    """Keeps an RfcIndex on disk so a restarted server can answer at once.
+
+    Every change is appended to index.log as one JSON line. Once
+    SNAPSHOT_EVERY records have been logged, a background thread rotates
+    the log and writes the whole index to index.snap, after which the
+    rotated log is deleted. Loading reads the snapshot and replays
+    whatever log is left. Replaying an event the snapshot already holds
+    does no harm: adds and peer removals give the same index when
+    applied twice in order.
+    """
+    SNAPSHOT_EVERY = 50000  # logged records between snapshots
+    FORMAT = 1
+
+    def __init__(self, directory, index):
+        self.directory = directory
+        self.index = index
+        self.snap = os.path.join(directory, 'index.snap')
+        self.log = os.path.join(directory, 'index.log')
+        self.old = self.log + '.old'  # log rotated out by a snapshot still being written
+        self.lock = threading.Lock()
+        self.file = None
+        self.logged = 0
+        self.compacting = False
+
+    def load(self):
+        """Restore the index from disk; returns the peers found there."""
+        os.makedirs(self.directory, exist_ok=True)
+        # a million records make a lot of tuples; collecting while building them only costs time
+        gc.disable()
+        try:
+            try:
+                with open(self.snap, 'rb') as file:
+                    self.index.restore(*decode(pickle.load(file)))
+            except FileNotFoundError:
+                pass
+            for path in (self.old, self.log):
+                self.logged += self.replay(path)
+        finally:
+            gc.enable()
+        self.file = open(self.log, 'a', encoding='utf-8')
+        if self.logged >= self.SNAPSHOT_EVERY or os.path.exists(self.old):
+            self.start_compaction()
+        return set(self.index.peers)
+
+    def replay(self, path):
+        count = 0
+        try:
+            file = open(path, encoding='utf-8')
+        except FileNotFoundError:
+            return 0
+        with file:
+            for line in file:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    break  # torn write at the end of the log
+                peer = (event[1], event[2])
+                if event[0] == 'A':
+                    self.index.add_many(peer, [tuple(record) for record in event[3]])
+                    count += len(event[3])
+                elif event[0] == 'R':
+                    self.index.remove_peer(peer)
+                    count += 1
+        return count
+
+    def added(self, peer, records):
+        """Log (num, title, root) records just added for peer."""
+        self.append(['A', peer[0], peer[1], records], len(records))
+
+    def removed(self, peer):
+        self.append(['R', peer[0], peer[1]], 1)
+
+    def append(self, event, count):
+        line = json.dumps(event, separators=(',', ':')) + '\n'
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(line)
+            self.file.flush()
+            self.logged += count
+            if self.logged < self.SNAPSHOT_EVERY or self.compacting:
+                return
+        self.start_compaction()
+
+    def start_compaction(self):
+        with self.lock:
+            if self.compacting:
+                return
+            self.compacting = True
+        threading.Thread(target=self.compact, daemon=True).start()
+
+    def compact(self):
+        try:
+            with self.lock:
+                # everything logged from here on may be missing from the snapshot
+                self.file.close()
+                if os.path.exists(self.old):
+                    # an earlier snapshot never finished: keep its log too
+                    with open(self.old, 'a', encoding='utf-8') as old, \
+                            open(self.log, encoding='utf-8') as log:
+                        old.write(log.read())
+                    os.remove(self.log)
+                else:
+                    os.replace(self.log, self.old)
+                self.file = open(self.log, 'a', encoding='utf-8')
+                self.logged = 0
+            state = encode(self.index.entries())
+            with open(self.snap + '.tmp', 'wb') as file:
+                pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(self.snap + '.tmp', self.snap)
+            os.remove(self.old)
+        finally:
+            with self.lock:
+                self.compacting = False
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# The snapshot is stored column by column: a table of peers, a table of
+# holder sets, then flat arrays and newline-joined strings with one slot
+# per RFC. Arrays and long strings unpickle at memory speed, and RFCs
+# sharing a holder set share one frozenset, leaving little to build.
+def encode(rfcs):
+    peer_ids = {}
+    set_ids = {}
+    owned = []
+    nums = array.array('q')
+    holders = array.array('i')
+    titles = []
+    roots = []
+    for num, (title, peers, root) in rfcs.items():
+        set_id = set_ids.get(peers)
+        if set_id is None:
+            set_id = set_ids[peers] = len(set_ids)
+        nums.append(num)
+        holders.append(set_id)
+        titles.append(title)
+        roots.append(root or '')
+    for peers in set_ids:
+        for peer in peers:
+            if peer not in peer_ids:
+                peer_ids[peer] = len(peer_ids)
+                owned.append(array.array('q'))
+    sets = [array.array('i', [peer_ids[peer] for peer in peers]) for peers in set_ids]
+    members = [[peer_ids[peer] for peer in peers] for peers in set_ids]
+    for num, set_id in zip(nums, holders):
+        for j in members[set_id]:
+            owned[j].append(num)
+    return {'format': Journal.FORMAT, 'peers': list(peer_ids), 'sets': sets,
+            'owned': owned, 'nums': nums, 'holders': holders,
+            'titles': '\n'.join(titles), 'roots': '\n'.join(roots)}
+
+
+def decode(state):
+    """Rebuild (rfcs, peers) for RfcIndex.restore from a snapshot."""
+    if state.get('format') != Journal.FORMAT:
+        raise ValueError('Unknown Snapshot Format')
+    table = state['peers']
+    if not state['nums']:
+        return {}, {}
+    sets = [frozenset(table[j] for j in members) for members in state['sets']]
+    titles = state['titles'].split('\n')
+    roots = [root or None for root in state['roots'].split('\n')]
+    rfcs = dict(zip(state['nums'], zip(titles, map(sets.__getitem__, state['holders']), roots)))
+    return rfcs, {peer: set(nums) for peer, nums in zip(table, state['owned'])}
@@ -0,0 +1,119 @@
+import socket
+import threading
+import time
+
+from protocol import SocketReader, frame
+
+
+class PeerPool(object):
+    """Idle connections to other peers, kept for the next request.
+
+    Uploaders serve any number of GETs on one connection, so fetching
+    many files from a peer costs one handshake instead of one per file.
+    At most per_peer idle connections are kept for each peer and total
+    overall, the oldest going first; one idle longer than idle_timeout
+    is closed instead of reused. idle_timeout stays below the uploader's
+    own, so the peer does not close a connection just as we pick it up.
+    """
+    PER_PEER = 4
+    TOTAL = 64
+    IDLE_TIMEOUT = 20
+
+    def __init__(self, per_peer=PER_PEER, total=TOTAL, idle_timeout=IDLE_TIMEOUT, timeout=10, bufsize=65536):
+        self.per_peer = per_peer
+        self.total = total
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.bufsize = bufsize  # bytes asked of each recv
+        self.lock = threading.Lock()
+        self.idle = {}  # peer -> [(time released, socket)], newest last
+        self.count = 0
+
+    def get(self, peer):
+        """A connection to peer; returns (socket, whether it was reused)."""
+        now = time.monotonic()
+        stale = []
+        soc = None
+        with self.lock:
+            conns = self.idle.get(peer, [])
+            while conns:
+                since, candidate = conns.pop()
+                self.count -= 1
+                if now - since < self.idle_timeout and alive(candidate):
+                    soc = candidate
+                    break
+                stale.append(candidate)
+            if not conns:
+                self.idle.pop(peer, None)
+        for candidate in stale:
+            candidate.close()
+        if soc is not None:
+            return soc, True
+        return socket.create_connection(peer, timeout=self.timeout), False
+
+    def release(self, peer, soc, reader=None):
+        """Keep soc for reuse; only call it once the last response has been read in full."""
+        if reader is not None and reader.buf:
+            soc.close()
+            return
+        evicted = []
+        with self.lock:
+            conns = self.idle.setdefault(peer, [])
+            conns.append((time.monotonic(), soc))
+            self.count += 1
+            if len(conns) > self.per_peer:
+                evicted.append(conns.pop(0)[1])
+                self.count -= 1
+            while self.count > self.total:
+                oldest = min(self.idle, key=lambda p: self.idle[p][0][0])
+                evicted.append(self.idle[oldest].pop(0)[1])
+                self.count -= 1
+                if not self.idle[oldest]:
+                    del self.idle[oldest]
+        for soc in evicted:
+            soc.close()
+
+    def request(self, peer, head, body=b''):
+        """Send one request to peer; returns (socket, reader, response head).
+
+        A reused connection the peer has meanwhile closed is dropped and
+        the request sent again, on a fresh connection once no idle one is
+        left. The caller reads the body from reader, then hands
+        the socket back through release() or closes it.
+        """
+        while True:
+            soc, reused = self.get(peer)
+            try:
+                soc.sendall(frame(head, body))
+                reader = SocketReader(soc, self.bufsize)
+                res = reader.read_head()
+                if res is None:
+                    raise ConnectionResetError('Peer closed the connection')
+                return soc, reader, res
+            except OSError:
+                soc.close()
+                if not reused:
+                    raise
+
+    def close(self):
+        with self.lock:
+            conns = [soc for idle in self.idle.values() for _, soc in idle]
+            self.idle.clear()
+            self.count = 0
+        for soc in conns:
+            soc.close()
+
+
+def alive(soc):
+    """Whether an idle connection is still open; an idle peer never sends anything."""
+    timeout = soc.gettimeout()
+    soc.setblocking(False)
+    try:
+        soc.recv(1, socket.MSG_PEEK)
+        return False  # closed, or sending what nobody asked for
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        soc.settimeout(timeout)
@@ -0,0 +1,244 @@
+import collections
+import re
+import threading
+from concurrent.futures import Future
+
+# A message is a start line and header lines terminated by a blank line.
+# When a Content-Length header is present, that many bytes of body follow.
+# A peer's GET response may instead carry Transfer-Encoding: chunked: the
+# body is '<hex length>\n<bytes>' pieces, ending with a piece of length 0.
+HEAD_END = re.compile(rb'\r?\n\r?\n')
+MAX_HEAD = 64 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class Message(object):
+    def __init__(self, lines, body=b''):
+        self.lines = lines
+        self.body = body
+
+    @property
+    def start(self):
+        return self.lines[0].split()
+
+    def header(self, name, default=None):
+        prefix = name.lower() + ':'
+        for line in self.lines[1:]:
+            if line.lower().startswith(prefix):
+                return line[len(prefix):].strip()
+        return default
+
+    @property
+    def length(self):
+        return int(self.header('Content-Length', 0))
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def frame(head, body=b''):
+    """Encode a header block (ending in a newline) and optional body."""
+    if body:
+        head += 'Content-Length: %s\n' % len(body)
+    return (head + '\n').encode() + body
+
+
+def frame_chunk(data):
+    """One piece of a body sent with Transfer-Encoding: chunked; b'' ends the body."""
+    return b'%x\n' % len(data) + data
+
+
+def is_start_line(line):
+    words = line.split()
+    return len(words) >= 2 and words[-1].startswith('P2P-CI/') and words[0].isupper()
+
+
+class MessageParser(object):
+    """Incremental parser: feed it bytes as they arrive, get whole messages back."""
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.head = None
+        self.framed = False
+
+    def feed(self, data):
+        self.buf += data
+        messages = []
+        while True:
+            if self.head is None:
+                # tolerate stray newlines between messages
+                while self.buf[:1] in (b'\n', b'\r'):
+                    del self.buf[:1]
+                match = HEAD_END.search(self.buf)
+                if match is None:
+                    if len(self.buf) > MAX_HEAD:
+                        raise ProtocolError('Header Too Large')
+                    return messages
+                self.framed = True
+                lines = bytes(self.buf[:match.start()]).decode().splitlines()
+                del self.buf[:match.end()]
+                self.head = Message(lines)
+            length = self.head.length
+            if len(self.buf) < length:
+                return messages
+            self.head.body = bytes(self.buf[:length])
+            del self.buf[:length]
+            messages.append(self.head)
+            self.head = None
+
+    def pending(self):
+        """Whether part of a message has arrived."""
+        return bool(self.buf) or self.head is not None
+
+    def flush(self):
+        """Accept requests from legacy peers that send no blank line.
+
+        Only used until the peer has sent one framed message, and only when
+        a read ends on a line boundary. Merged requests are split on their
+        start lines.
+        """
+        if self.framed or self.head is not None or not self.buf.endswith(b'\n'):
+            return []
+        messages = []
+        for line in bytes(self.buf).decode().splitlines():
+            if not line:
+                continue
+            if is_start_line(line) or not messages:
+                messages.append(Message([line]))
+            else:
+                messages[-1].lines.append(line)
+        self.buf.clear()
+        return messages
+
+
+class SocketReader(object):
+    """Blocking reader that leaves large bodies on the socket for streaming."""
+
+    def __init__(self, sock, bufsize=65536):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.buf = bytearray()
+
+    def read_head(self):
+        while True:
+            while self.buf[:1] in (b'\n', b'\r'):
+                del self.buf[:1]
+            match = HEAD_END.search(self.buf)
+            if match is not None:
+                lines = bytes(self.buf[:match.start()]).decode().splitlines()
+                del self.buf[:match.end()]
+                return Message(lines)
+            if len(self.buf) > MAX_HEAD:
+                raise ProtocolError('Header Too Large')
+            data = self.sock.recv(self.bufsize)
+            if not data:
+                if self.buf:
+                    raise ConnectionResetError('Connection closed mid-message')
+                return None
+            self.buf += data
+
+    def read_message(self):
+        msg = self.read_head()
+        if msg is not None:
+            msg.body = self.read_exact(msg.length)
+        return msg
+
+    def read_exact(self, n):
+        return b''.join(self.iter_body(n))
+
+    def iter_chunks(self):
+        """Yield the pieces of a Transfer-Encoding: chunked body; its empty last chunk is read, not yielded."""
+        while True:
+            while b'\n' not in self.buf:
+                if len(self.buf) > 16:
+                    raise ProtocolError('Bad Chunk Size')
+                data = self.sock.recv(self.bufsize)
+                if not data:
+                    raise ConnectionResetError('Connection closed mid-body')
+                self.buf += data
+            i = self.buf.index(b'\n')
+            try:
+                n = int(bytes(self.buf[:i]).strip(), 16)
+            except ValueError:
+                raise ProtocolError('Bad Chunk Size')
+            del self.buf[:i + 1]
+            if not n:
+                return
+            for chunk in self.iter_body(n):
+                yield chunk
+
+    def iter_body(self, n):
+        if self.buf:
+            chunk = bytes(self.buf[:n])
+            del self.buf[:n]
+            n -= len(chunk)
+            yield chunk
+        while n > 0:
+            chunk = self.sock.recv(min(self.bufsize, n))
+            if not chunk:
+                raise ConnectionResetError('Connection closed mid-body')
+            n -= len(chunk)
+            yield chunk
+
+
+class Connection(object):
+    """Client side of a connection to the index server.
+
+    Requests can be pipelined: request() returns a Future which a
+    background reader thread resolves with the matching response, in the
+    order the requests were sent. Messages the server pushes unasked
+    (NOTIFY) go to on_push instead, on the reader thread.
+    """
+
+    def __init__(self, sock, on_push=None):
+        self.sock = sock
+        self.on_push = on_push
+        self.parser = MessageParser()
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.error = None
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    def request(self, head, body=b''):
+        return self.request_many([(head, body)])[0]
+
+    def request_many(self, requests):
+        futures = [Future() for _ in requests]
+        data = b''.join(frame(head, body) for head, body in requests)
+        with self.lock:
+            if self.error is not None:
+                raise ConnectionResetError('Server Not Available')
+            self.pending.extend(futures)
+            self.sock.sendall(data)
+        return futures
+
+    def call(self, head, body=b''):
+        return self.request(head, body).result()
+
+    def pipeline(self, requests):
+        return [future.result() for future in self.request_many(requests)]
+
+    def read_loop(self):
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    raise ConnectionResetError('Server closed the connection')
+                for msg in self.parser.feed(data):
+                    if msg.start[0] == 'NOTIFY':
+                        if self.on_push is not None:
+                            self.on_push(msg)
+                        continue
+                    self.pending.popleft().set_result(msg)
+        except Exception as e:
+            with self.lock:
+                self.error = e
+                while self.pending:
+                    self.pending.popleft().set_exception(e)
+
+    def close(self):
+        self.sock.close()
@@ -1,39 +1,28 @@
-import sqlite3
-import os 
-import sys
-from root_dir import ROOT_DIR 
-
-def setup_database():
-    conn = sqlite3.connect(os.path.join(ROOT_DIR , 'users.db'))
-    cursor = conn.cursor()
-
-    # Create users table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL
-    )
-    ''')
-    conn.commit()
-    conn.close()
+import threading
+
+from auth import AuthStore
+
+# one store per process, shared by every thread; a client hashes on
+# threads, so it needs no worker processes of its own
+_store = None
+_lock = threading.Lock()
+
+
+def store(path=None):
+    global _store
+    with _lock:
+        if _store is None:
+            _store = AuthStore(path, processes=False)
+        return _store
+
+
+def setup_database(path=None):
+    store(path)
+
 
 def add_user(username, password):
-    conn = sqlite3.connect(os.path.join(ROOT_DIR , 'users.db'))
-    cursor = conn.cursor()
-    try:
-        cursor.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, password))
-        conn.commit()
-    except sqlite3.IntegrityError:
-        return False  # Username already exists
-    finally:
-        conn.close()
-    return True
+    return store().add_user(username, password)  # False if the username exists
+
 
 def verify_user(username, password):
-    conn = sqlite3.connect(os.path.join(ROOT_DIR , 'users.db'))
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE username = ? AND password = ?', (username, password))
-    user = cursor.fetchone()
-    conn.close()
-    return user is not None
\ No newline at end of file
+    return store().verify_user(username, password)
@@ -0,0 +1,66 @@
+import math
+import threading
+import time
+
+
+class PeerScores(object):
+    """How well each peer has served downloads lately, from clients' REPORTs.
+
+    Every peer keeps decayed sums of the bytes and seconds it has
+    delivered and of its successful and failed transfers; old evidence
+    halves in weight every half_life seconds. A peer's score is its
+    expected throughput (delivered bytes over seconds, both padded with
+    PRIOR_SECONDS at PRIOR_RATE) times its chance of not failing. A
+    peer nobody has reported on scores the prior, so new holders still
+    get tried, and one that went bad drifts back there as its failures
+    age.
+    """
+    HALF_LIFE = 600  # seconds
+    PRIOR_RATE = 1 << 20  # bytes per second assumed for a peer nobody has reported on
+    PRIOR_SECONDS = 1.0
+    MAX_SECONDS = 3600  # one report counts for at most this long a transfer
+
+    def __init__(self, half_life=HALF_LIFE, clock=time.monotonic):
+        self.half_life = half_life
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.stats = {}  # peer -> [bytes, seconds, successes, failures, when last decayed]
+
+    def decayed(self, peer, now):
+        entry = self.stats.get(peer)
+        if entry is None:
+            entry = self.stats[peer] = [0.0, 0.0, 0.0, 0.0, now]
+        elif now > entry[4]:
+            factor = math.pow(0.5, (now - entry[4]) / self.half_life)
+            for i in range(4):
+                entry[i] *= factor
+            entry[4] = now
+        return entry
+
+    def report(self, peer, size, seconds, failures=0):
+        """Record that peer delivered size bytes in seconds, after failing failures times."""
+        seconds = min(max(seconds, 0.001), self.MAX_SECONDS)
+        with self.lock:
+            entry = self.decayed(peer, self.clock())
+            if size:
+                entry[0] += size
+                entry[1] += seconds
+                entry[2] += 1
+            entry[3] += failures
+
+    def score(self, peer):
+        with self.lock:
+            entry = self.stats.get(peer)
+            if entry is None:
+                return self.PRIOR_RATE / 2
+            entry = self.decayed(peer, self.clock())
+        rate = (entry[0] + self.PRIOR_RATE * self.PRIOR_SECONDS) / (entry[1] + self.PRIOR_SECONDS)
+        return rate * (entry[2] + 1) / (entry[2] + entry[3] + 2)
+
+    def rank(self, peers):
+        """peers, best first."""
+        return sorted(peers, key=self.score, reverse=True)
+
+    def forget(self, peer):
+        with self.lock:
+            self.stats.pop(peer, None)
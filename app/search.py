@@ -0,0 +1,144 @@
+import bisect
+import heapq
+import itertools
+import math
+import re
+import threading
+
+WORD = re.compile(r'\w+')
+
+
+def tokens(text):
+    return WORD.findall(text.lower())
+
+
+class TitleIndex(object):
+    """Inverted index from title words to RFC numbers.
+
+    postings maps each word to the set of RFCs whose title contains it;
+    vocab keeps the words sorted so a prefix query is a bisect plus a
+    short slice. A query only touches the postings of its own terms.
+    Every matching RFC scores the idf of each term it matches, a prefix
+    match counting for less than the whole word, and results come out
+    best first.
+    """
+    PREFIX_LIMIT = 100  # words a prefix term may expand to
+    PREFIX_WEIGHT = 0.5
+    BUILD_CHUNK = 10000  # titles indexed per lock hold when building in bulk
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.vocab = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, num, title):
+        with self.lock:
+            new = self._add(num, title)
+            for word in new:
+                bisect.insort(self.vocab, word)
+
+    # caller holds the lock; returns the words seen for the first time
+    def _add(self, num, title):
+        new = []
+        added = False
+        for word in set(tokens(title or '')):
+            nums = self.postings.get(word)
+            if nums is None:
+                nums = self.postings[word] = set()
+                new.append(word)
+            if num not in nums:
+                nums.add(num)
+                added = True
+        if added:
+            self.count += 1
+        return new
+
+    def remove(self, num, title):
+        with self.lock:
+            removed = False
+            for word in set(tokens(title or '')):
+                nums = self.postings.get(word)
+                if nums is None or num not in nums:
+                    continue
+                nums.discard(num)
+                removed = True
+                if not nums:
+                    del self.postings[word]
+                    i = bisect.bisect_left(self.vocab, word)
+                    if i < len(self.vocab) and self.vocab[i] == word:
+                        del self.vocab[i]
+            if removed:
+                self.count -= 1
+
+    def build(self, items):
+        """Index many (num, title) pairs, letting add() and search() in between chunks."""
+        items = iter(items)
+        while True:
+            chunk = list(itertools.islice(items, self.BUILD_CHUNK))
+            if not chunk:
+                return
+            with self.lock:
+                new = []
+                for num, title in chunk:
+                    new.extend(self._add(num, title))
+                # timsort merges the two sorted runs in linear time
+                self.vocab.extend(sorted(new))
+                self.vocab.sort()
+
+    def expand(self, term):
+        """Words starting with term, at most PREFIX_LIMIT of them."""
+        i = bisect.bisect_left(self.vocab, term)
+        words = []
+        for word in self.vocab[i:i + self.PREFIX_LIMIT]:
+            if not word.startswith(term):
+                break
+            words.append(word)
+        return words
+
+    def search(self, query):
+        """Yield RFC numbers matching query, best first.
+
+        Words in the query are matched whole; a word ending in '*' also
+        matches every word it starts.
+        """
+        scores = {}
+        with self.lock:
+            total = max(self.count, 1)
+            for term in query.lower().split():
+                prefix = term.endswith('*')
+                words = tokens(term)
+                if not words:
+                    continue
+                # 'tcp/ip' is two terms, only the last of them a prefix
+                for word in words[:-1]:
+                    self.score(scores, word, total, 1.0)
+                word = words[-1]
+                if not prefix:
+                    self.score(scores, word, total, 1.0)
+                    continue
+                best = {}
+                for match in self.expand(word):
+                    weight = 1.0 if match == word else self.PREFIX_WEIGHT
+                    self.score(best, match, total, weight, keep_max=True)
+                for num, score in best.items():
+                    scores[num] = scores.get(num, 0) + score
+        ranked = [(-score, num) for num, score in scores.items()]
+        heapq.heapify(ranked)
+        while ranked:
+            yield heapq.heappop(ranked)[1]
+
+    # caller holds the lock
+    def score(self, scores, word, total, weight, keep_max=False):
+        nums = self.postings.get(word)
+        if not nums:
+            return
+        idf = weight * math.log(1 + total / len(nums))
+        for num in nums:
+            if keep_max:
+                scores[num] = max(scores.get(num, 0), idf)
+            else:
+                scores[num] = scores.get(num, 0) + idf
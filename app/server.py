@@ -1,179 +1,767 @@
+import argparse
+import asyncio
+import collections
+import logging
+import queue
+import selectors
+import signal
 import socket
 import threading
 import os
 import sys
-import sqlite3
-from collections import defaultdict
+import time
+from concurrent.futures import Future
 from root_dir import ROOT_DIR 
+from protocol import MessageParser, ProtocolError
+from index import RfcIndex
+from persist import Journal
+from leases import LeaseTable
+from search import TitleIndex
+from scores import PeerScores
+from metrics import Registry, TimedLock, serve_http
+from auth import AuthStore, chain
+import logs
+from logs import Sampler, event
+from watch import Watchlist, PollSubscriber, StreamSubscriber, notice
+
+log = logging.getLogger('p2p.server')
+
+
+class Session(object):
+    """Per-connection state shared by the threaded and asyncio front ends."""
+
+    def __init__(self, addr, channel=None):
+        self.addr = addr
+        self.channel = channel  # the socket, or the asyncio StreamWriter
+        self.host = None
+        self.port = None
+        self.parser = MessageParser()
+        self.active = time.monotonic()  # when the peer last sent anything
+        self.began = None  # when the first byte of a request still incomplete arrived
+        self.send_lock = threading.Lock()  # responses and notifications never interleave
+        self.writing = False  # a response is partly written (asyncio)
+        self.subscriber = None  # set by the first WATCH
+
+    def read(self, data):
+        """Feed data to the parser and return the whole messages in it."""
+        messages = self.parser.feed(data) + self.parser.flush()
+        self.active = time.monotonic()
+        if not self.parser.pending():
+            self.began = None
+        elif messages or self.began is None:
+            self.began = self.active  # what is left over is the start of the next request
+        return messages
+
 
 class Server(object):
-    def __init__(self, HOST='localhost', PORT=7734, V='P2P-CI/1.0'):
+    PAGE_SIZE = 1000  # RFCs copied out of the index per page when streaming LIST
+    GRACE = 300  # seconds restored peers have to register again before they are dropped
+    LEASE = 90  # seconds a peer stays listed after its last ADD or HEARTBEAT
+    REAP_INTERVAL = 1  # seconds between sweeps for expired leases
+    SEARCH_LIMIT = 20  # RFCs returned by SEARCH without a Limit header
+    MAX_REPORTED_FAILURES = 3  # failures one REPORT line can charge a peer with
+    VERBS = ('ADD', 'ADD BULK', 'HEARTBEAT', 'LOOKUP', 'WATCH', 'UNWATCH', 'SEARCH', 'LIST', 'LOGIN',
+             'SIGNUP', 'REPORT', 'STATS')  # anything else is counted as OTHER
+    BACKLOG = 1024  # connections the kernel holds for us before accept
+    WORKERS = 32  # threads answering requests
+    QUEUE = 1024  # connections with a request waiting for a worker; beyond that, 503
+    MAX_CONNECTIONS = 10000
+    IDLE_TIMEOUT = 120  # seconds a silent connection is kept; well above the clients' heartbeat interval
+    READ_TIMEOUT = 10  # seconds to send the rest of a request once it is started
+    WRITE_TIMEOUT = 10  # seconds a peer may leave a response unread before it is dropped
+    RETRY_AFTER = 5  # seconds, suggested to peers turned away by a 503
+    SWEEP_INTERVAL = 1  # seconds between checks for idle connections
+    LOG_SAMPLE = 0.01  # share of requests logged with their full text, at DEBUG
+
+    def __init__(self, HOST='localhost', PORT=7734, V='P2P-CI/1.0', state=None, grace=GRACE, lease=LEASE,
+                 db=None, backlog=BACKLOG, workers=WORKERS, max_connections=MAX_CONNECTIONS,
+                 idle_timeout=IDLE_TIMEOUT, log_sample=LOG_SAMPLE):
         self.HOST = HOST
         self.PORT = PORT
         self.V = V
-        self.peers = defaultdict(set)
-        self.rfcs = {}
-        self.lock = threading.Lock()
-        self.setup_database()
-
-    def setup_database(self):
-        self.conn = sqlite3.connect(os.path.join(ROOT_DIR , 'users.db'))
-        self.cursor = self.conn.cursor()
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL
-            )
-        ''')
-        self.conn.commit()
+        self.backlog = backlog
+        self.workers = workers
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.sample = Sampler(log_sample)  # which requests have their text logged
+        self.connections = 0
+        self.answering = 0  # workers busy with a request
+        self.count_lock = threading.Lock()
+        self.lease = lease
+        self.metrics = Registry()
+        waits = self.metrics.histogram('p2p_index_lock_wait_seconds', 'Time spent waiting for a contended index lock')
+        self.index = RfcIndex(titles=TitleIndex(), lock=lambda: TimedLock(waits))
+        self.leases = LeaseTable()
+        self.watchlist = Watchlist()
+        self.scores = PeerScores()  # how well each peer has served downloads, from REPORTs
+        self.journal = None
+        # peers restored from disk that have not registered since the restart
+        self.provisional = set()
+        if state:
+            self.restore(state, grace)
+        self.setup_database(db)
+        self.gauges()
+        threading.Thread(target=self.reap, daemon=True).start()
+
+    def restore(self, state, grace):
+        self.journal = Journal(state, self.index)
+        self.provisional = self.journal.load()
+        if self.provisional:
+            event(log, logging.INFO, 'restored', rfcs=len(self.index), peers=len(self.provisional),
+                  grace=grace)
+        for peer in self.provisional:
+            self.leases.renew(peer, grace)
+
+    def gauges(self):
+        gauge = self.metrics.gauge
+        gauge('p2p_index_rfcs', lambda: len(self.index), 'RFCs with at least one holder')
+        gauge('p2p_index_peers', lambda: len(self.index.peers), 'Peers holding at least one RFC')
+        gauge('p2p_leases', lambda: len(self.leases.deadlines), 'Peers with a lease')
+        gauge('p2p_provisional_peers', lambda: len(self.provisional), 'Restored peers yet to register again')
+        gauge('p2p_connections', lambda: self.connections, 'Open client connections')
+        gauge('p2p_workers_busy', lambda: self.answering, 'Worker threads answering a request')
+        gauge('p2p_work_queue', lambda: self.work.qsize() if hasattr(self, 'work') else 0,
+              'Connections with a request waiting for a worker')
+        gauge('p2p_threads', threading.active_count, 'Live threads in the server process')
+
+    # drop peers that stopped sending heartbeats, or never came back after a restart
+    def reap(self):
+        while True:
+            time.sleep(self.REAP_INTERVAL)
+            for peer in self.leases.expired():
+                event(log, logging.INFO, 'expired', peer='%s:%s' % peer)
+                self.provisional.discard(peer)
+                self.clear(*peer)
+
+    # handler threads share a pool of SQLite connections rather than one cursor,
+    # and password hashing runs in worker processes
+    def setup_database(self, path=None):
+        self.auth = AuthStore(path)
 
     def add_user(self, username, password):
-        try:
-            self.cursor.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, password))
-            self.conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False  # Username already exists
+        return self.auth.add_user(username, password)  # False if the username exists
 
     def verify_user(self, username, password):
-        self.cursor.execute('SELECT * FROM users WHERE username = ? AND password = ?', (username, password))
-        user = self.cursor.fetchone()
-        return user is not None
+        return self.auth.verify_user(username, password)
 
     # start listening
     def start(self):
         try:
             self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.s.bind((self.HOST, self.PORT))
-            self.s.listen(5)
+            self.s.listen(self.backlog)
+            self.s.setblocking(False)
             print('\n\n---------------Server %s is listening on port %s--------------' %
                   (self.V, self.PORT))
-
-            while True:
-                soc, addr = self.s.accept()
-                print('%s:%s connected' % (addr[0], addr[1]))
-                thread = threading.Thread(
-                    target=self.handler, args=(soc, addr))
-                thread.start()
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.s, selectors.EVENT_READ)
+            # workers hand connections back through resumed, and wake the selector
+            self.waker, self.wake = socket.socketpair()
+            self.waker.setblocking(False)
+            self.selector.register(self.waker, selectors.EVENT_READ)
+            self.resumed = collections.deque()
+            self.ready = collections.deque()  # responses a Future held up, now ready for a worker
+            self.flushes = collections.deque()  # subscribers with notifications to write
+            self.unflushed = set()  # ... and those the poll thread could not finish yet
+            self.work = queue.Queue(self.QUEUE)
+            for _ in range(self.workers):
+                threading.Thread(target=self.worker, daemon=True).start()
+            self.poll()
         except KeyboardInterrupt:
-            print('\n---------------Shutting down the server..-----------------\n---------------Good Bye!-----------------\n\n')
-            self.conn.close()  # Close the database connection
+            self.shutdown()
+
+    # one thread waits on every idle connection; workers only see ones with data
+    def poll(self):
+        swept = time.monotonic()
+        while True:
+            for key, _ in self.selector.select(self.SWEEP_INTERVAL):
+                if key.fileobj is self.s:
+                    self.accept()
+                elif key.fileobj is self.waker:
+                    self.waker.recv(4096)
+                    while self.resumed:
+                        soc, session = self.resumed.popleft()
+                        self.selector.register(soc, selectors.EVENT_READ, session)
+                    while self.flushes:
+                        self.unflushed.add(self.flushes.popleft())
+                else:
+                    self.dispatch(key.fileobj, key.data)
+            # they already hold their place in line; a full queue only delays them to a later pass
+            while self.ready:
+                try:
+                    self.work.put_nowait(self.ready[0])
+                except queue.Full:
+                    break
+                self.ready.popleft()
+            # a peer that is not reading, or a response being sent, holds them up till a later pass
+            for subscriber in list(self.unflushed):
+                if subscriber.flush():
+                    self.unflushed.discard(subscriber)
+            if time.monotonic() - swept >= self.SWEEP_INTERVAL:
+                swept = time.monotonic()
+                self.sweep(swept)
+
+    def accept(self):
+        while True:
             try:
-                sys.exit(0)
-            except SystemExit:
-                os._exit(0)
+                soc, addr = self.s.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            with self.count_lock:
+                full = self.connections >= self.max_connections
+                if not full:
+                    self.connections += 1
+            if full:
+                # refuse with a retry hint rather than leave the peer hanging
+                try:
+                    soc.setblocking(False)
+                    soc.send(self.busy().encode())
+                except OSError:
+                    pass
+                soc.close()
+                continue
+            event(log, logging.INFO, 'connected', addr='%s:%s' % addr[:2])
+            soc.settimeout(self.WRITE_TIMEOUT)
+            self.selector.register(soc, selectors.EVENT_READ, Session(addr, soc))
 
-    # connect with a client
-    def handler(self, soc, addr):
-        host = None
-        port = None
+    def dispatch(self, soc, session):
+        self.selector.unregister(soc)
+        try:
+            self.work.put_nowait((soc, session, None))
+        except queue.Full:
+            self.shed(soc, session)
+
+    # every worker is busy and the queue is full: answer 503 without doing the work
+    def shed(self, soc, session):
+        try:
+            data = soc.recv(65536)
+            if not data:
+                raise ConnectionResetError
+            count = len(session.read(data))
+            reply = self.unsent(session) + self.busy().encode() * count
+            with session.send_lock:
+                soc.setblocking(False)  # the poll thread must not wait on a peer that does not read
+                if soc.send(reply) < len(reply):
+                    raise BlockingIOError
+                soc.settimeout(self.WRITE_TIMEOUT)
+        except (OSError, ProtocolError, ValueError):
+            self.close(soc, session)
+            return
+        self.selector.register(soc, selectors.EVENT_READ, session)
+
+    def busy(self):
+        return self.V + ' 503 Service Unavailable\nRetry-After: %s\n\n' % self.RETRY_AFTER
+
+    # close connections that went quiet, or stopped halfway through a request
+    def sweep(self, now):
+        for key in list(self.selector.get_map().values()):
+            session = key.data
+            if session is None:
+                continue
+            if session.parser.pending():
+                if now - session.began <= self.READ_TIMEOUT:
+                    continue
+                try:
+                    with session.send_lock:
+                        soc = key.fileobj
+                        soc.setblocking(False)
+                        soc.send(self.unsent(session) + str.encode(self.V + ' 408 Request Timeout\n\n'))
+                except OSError:
+                    pass
+            elif now - session.active <= self.idle_timeout:
+                continue
+            self.selector.unregister(key.fileobj)
+            self.close(key.fileobj, session)
+
+    def worker(self):
         while True:
+            soc, session, responses = self.work.get()
+            with self.count_lock:
+                self.answering += 1
             try:
-                req = soc.recv(1024).decode()
-                print('Receive request:\n%s' % req)
-                lines = req.splitlines()
-                version = lines[0].split()[-1]
-
-                if version != self.V:
-                    soc.sendall(str.encode(
-                        self.V + ' 505 P2P-CI Version Not Supported\n'))
+                self.settle(soc, session, self.answer(soc, session, responses))
+            except Exception:
+                log.exception('worker failed')  # one bad request must not cost the pool a thread
+            finally:
+                with self.count_lock:
+                    self.answering -= 1
+
+    # where a connection goes once a worker or a Future's callback is done with it
+    def settle(self, soc, session, alive):
+        if alive:
+            self.resumed.append((soc, session))
+            self.wake.send(b'.')
+            if session.subscriber is not None:
+                self.schedule_flush(session.subscriber)  # notifications held back by the responses
+        # False: closed already; None: parked until a Future's callback resumes it
+
+    # a Future's callback, on whatever thread finished it: only queue the responses
+    # left for a worker, through the poll thread, so that thread never waits on a peer
+    def resume(self, soc, session, responses):
+        self.ready.append((soc, session, responses))
+        self.wake.send(b'.')
+
+    # caller holds the send lock: the end of a notification cut short, which goes first
+    def unsent(self, session):
+        return session.subscriber.cut() if session.subscriber is not None else b''
+
+    def close(self, soc, session):
+        self.leave(session)
+        soc.close()
+        with self.count_lock:
+            self.connections -= 1
+
+    def shutdown(self):
+        print('\n---------------Shutting down the server..-----------------\n---------------Good Bye!-----------------\n\n')
+        self.auth.close()  # Close the database connections
+        if self.journal is not None:
+            self.journal.close()
+        logs.stop()  # os._exit skips atexit, and would drop the queued log records
+        try:
+            sys.exit(0)
+        except SystemExit:
+            os._exit(0)
+
+    # answer what one connection sent, or carry on with responses a Future held up.
+    # True when done, False once the connection is closed, None while a response
+    # waits on a Future: the worker is free, and the connection stays out of the
+    # selector, so later requests cannot overtake it, until the Future's callback
+    # queues the rest for a worker
+    def answer(self, soc, session, responses=None):
+        try:
+            if responses is None:
+                data = soc.recv(65536)
+                if not data:
+                    raise ConnectionResetError
+                responses = self.process(session.read(data), session)
+            with session.send_lock:
+                soc.sendall(self.unsent(session))
+                for chunk in responses:
+                    if not isinstance(chunk, Future):
+                        soc.sendall(chunk)
+                    elif not chunk.done():
+                        break
                 else:
-                    method = lines[0].split()[0]
-                    if method == 'ADD':
-                        host = lines[1].split(None, 1)[1]
-                        port = int(lines[2].split(None, 1)[1])
-                        num = int(lines[0].split()[-2])
-                        title = lines[3].split(None, 1)[1]
-                        self.addRecord(soc, (host, port), num, title)
-                    elif method == 'LOOKUP':
-                        num = int(lines[0].split()[-2])
-                        self.getPeersOfRfc(soc, num)
-                    elif method == 'LIST':
-                        self.getAllRecords(soc)
-                    elif method == 'LOGIN':
-                        username = lines[1].split(None, 1)[1]
-                        password = lines[2].split(None, 1)[1]
-                        if self.verify_user(username, password):
-                            soc.sendall(str.encode(self.V + ' 200 Login Successful\n'))
-                        else:
-                            soc.sendall(str.encode(self.V + ' 401 Unauthorized\n'))
-                    elif method == 'SIGNUP':
-                        username = lines[1].split(None, 1)[1]
-                        password = lines[2].split(None, 1)[1]
-                        if self.add_user(username, password):
-                            soc.sendall (str.encode(self.V + ' 201 Signup Successful\n'))
-                        else:
-                            soc.sendall(str.encode(self.V + ' 409 Conflict: Username already exists\n'))
-                    else:
-                        raise AttributeError('Method Not Match')
-            except ConnectionError:
-                print('%s:%s left' % (addr[0], addr[1]))
-                if host and port:
-                    self.clear(host, port)
-                soc.close()
-                break
-            except BaseException:
+                    return True
+            # outside the lock: a Future done by now runs the callback right here.
+            # Every earlier response is out, and NOTIFY gets through while the hash runs
+            chunk.add_done_callback(lambda _: self.resume(soc, session, responses))
+            return None
+        except (ProtocolError, ValueError):
+            try:
+                with session.send_lock:
+                    soc.sendall(self.unsent(session) + str.encode(self.V + ' 400 Bad Request\n\n'))
+            except OSError:
+                pass
+        except OSError:
+            pass  # the peer left, or stopped reading its responses
+        except Exception:
+            log.exception('request failed')
+        self.close(soc, session)
+        return False
+
+    def leave(self, session):
+        event(log, logging.INFO, 'left', addr='%s:%s' % session.addr[:2])
+        if session.subscriber is not None:
+            self.watchlist.drop(session.subscriber)
+        if session.host and session.port:
+            self.clear(session.host, session.port)
+
+    # answer every message; responses are sent in request order.
+    # A Future is yielded for a response that is still being worked out
+    # elsewhere; the caller waits for it before asking for the next chunk.
+    def process(self, messages, session):
+        out = []
+        for msg in messages:
+            began = time.perf_counter()
+            try:
+                res = self.respond(msg, session)
+            except Exception:
+                res = self.V + ' 400 Bad Request\n'
+            if isinstance(res, Future):
+                if out:
+                    yield ''.join(out).encode()
+                    out = []
+                yield res
                 try:
-                    soc.sendall(str.encode(self.V + ' 400 Bad Request\n'))
-                except ConnectionError:
-                    print('%s:%s left' % (addr[0], addr[1]))
-                    if host and port:
-                        self.clear(host, port)
-                    soc.close()
-                    break
+                    res = res.result()
+                except Exception:
+                    res = self.V + ' 400 Bad Request\n'
+            if isinstance(res, str):
+                status = res
+                out.append(res)
+            else:
+                # streamed response: flush what we have after every page
+                status = None
+                for chunk in res:
+                    status = status or chunk
+                    out.append(chunk)
+                    yield ''.join(out).encode()
+                    out = []
+            # a blank line ends each response
+            out.append('\n')
+            self.measure(msg, status, time.perf_counter() - began, session)
+        if out:
+            yield ''.join(out).encode()
+
+    # count the request and how long its response took, by verb and status;
+    # log it at DEBUG, with the request text for a sample of them
+    def measure(self, msg, response, elapsed, session):
+        verb = ' '.join(msg.start[:2]) if msg.start[:2] == ['ADD', 'BULK'] else msg.start[0]
+        if verb not in self.VERBS:
+            verb = 'OTHER'
+        status = (response or '').split(None, 2)[1:2] or ['none']
+        self.metrics.counter('p2p_requests_total', 'Requests answered, by verb and status',
+                             verb=verb, status=status[0]).inc()
+        self.metrics.histogram('p2p_request_seconds', 'Time from request to complete response, by verb',
+                               verb=verb).observe(elapsed)
+        if log.isEnabledFor(logging.DEBUG):
+            fields = {'addr': '%s:%s' % session.addr[:2], 'verb': verb, 'status': status[0],
+                      'ms': round(elapsed * 1000, 3)}
+            if self.sample():
+                fields['text'] = msg.text()
+            event(log, logging.DEBUG, 'request', **fields)
+
+    # build the response to one request
+    def respond(self, msg, session):
+        lines = msg.lines
+        version = msg.start[-1]
+
+        if version != self.V:
+            return self.V + ' 505 P2P-CI Version Not Supported\n'
+        method = msg.start[0]
+        if method == 'ADD' and msg.start[1] == 'BULK':
+            # ADD BULK V, with one '<num> <root or -> <title>' line per RFC in the body
+            session.host = msg.header('Host')
+            session.port = int(msg.header('Port'))
+            records = []
+            for line in msg.body.decode().splitlines():
+                num, root, title = line.split(None, 2)
+                records.append((int(num), title, None if root == '-' else root))
+            return self.addRecords((session.host, session.port), records)
+        elif method == 'ADD':
+            # an untitled RFC could be neither indexed for SEARCH nor listed
+            title = msg.header('Title')
+            if not title:
+                return self.V + ' 400 Bad Request\n'
+            session.host = msg.header('Host')
+            session.port = int(msg.header('Port'))
+            num = int(msg.start[-2])
+            return self.addRecord((session.host, session.port), num, title, msg.header('Root'))
+        elif method == 'HEARTBEAT':
+            session.host = msg.header('Host')
+            session.port = int(msg.header('Port'))
+            return self.heartbeat((session.host, session.port))
+        elif method == 'LOOKUP':
+            num = int(msg.start[-2])
+            return self.getPeersOfRfc(num)
+        elif method in ('WATCH', 'UNWATCH'):
+            # WATCH RFC <num> [<num> ...] V; changes to those RFCs are pushed as NOTIFY messages
+            nums = [int(num) for num in msg.start[2:-1]]
+            if session.subscriber is None:
+                session.subscriber = self.make_subscriber(session)
+            if method == 'WATCH':
+                count = self.watchlist.watch(session.subscriber, nums)
+            else:
+                count = self.watchlist.unwatch(session.subscriber, nums)
+            return self.V + ' 200 OK\nWatching: %s\n' % count
+        elif method == 'SEARCH':
+            # SEARCH RFC V, with the query in the Title header
+            limit = max(1, min(int(msg.header('Limit', self.SEARCH_LIMIT)), self.PAGE_SIZE))
+            return self.search(msg.header('Title', ''), limit)
+        elif method == 'REPORT':
+            # REPORT RFC <num> V, with one '<host> <port> <bytes> <seconds> <failures>' line per peer in the body
+            count = 0
+            for line in msg.body.decode().splitlines():
+                host, port, size, seconds, failures = line.split()
+                peer = (host, int(port))
+                if peer in self.index.peers:
+                    self.scores.report(peer, max(int(size), 0), float(seconds),
+                                       min(max(int(failures), 0), self.MAX_REPORTED_FAILURES))
+                    count += 1
+            return self.V + ' 200 OK\nReported: %s\n' % count
+        elif method == 'STATS':
+            # STATS V; every metric, one sample per line, in the Prometheus text format
+            return self.V + ' 200 OK\n' + self.metrics.render()
+        elif method == 'LIST':
+            # LIST ALL [<cursor> <limit>] V
+            if len(msg.start) == 5:
+                limit = int(msg.start[3])
+                if limit < 0:
+                    return self.V + ' 400 Bad Request\n'
+                return self.getRecordsPage(int(msg.start[2]), max(1, min(limit, self.PAGE_SIZE)))
+            return self.getAllRecords()
+        elif method == 'LOGIN':
+            # a token from an earlier login is checked without hashing anything
+            token = msg.header('Token')
+            if token is not None:
+                username = self.auth.check_token(token)
+                if username is None:
+                    return self.V + ' 401 Unauthorized\n'
+                return self.loggedIn(username, token)
+            username = lines[1].split(None, 1)[1]
+            password = lines[2].split(None, 1)[1]
+            return chain(self.auth.verify_user_async(username, password),
+                         lambda ok: self.loggedIn(username) if ok else self.V + ' 401 Unauthorized\n')
+        elif method == 'SIGNUP':
+            username = lines[1].split(None, 1)[1]
+            password = lines[2].split(None, 1)[1]
+            return chain(self.auth.add_user_async(username, password),
+                         lambda ok: self.V + (' 201 Signup Successful\n' if ok else
+                                              ' 409 Conflict: Username already exists\n'))
+        raise AttributeError('Method Not Match')
+
+    def loggedIn(self, username, token=None):
+        return self.V + ' 200 Login Successful\nToken: %s\n' % (token or self.auth.issue_token(username))
 
     def clear(self, host, port):
-        self.lock.acquire()
-        nums = self.peers[(host, port)]
-        for num in nums:
-            self.rfcs[num][1].discard((host, port))
-        if not self.rfcs[num][1]:
-            self.rfcs.pop(num, None)
-        self.peers.pop((host, port), None)
-        self.lock.release()
-
-    def addRecord(self, soc, peer, num, title):
-        self.lock.acquire()
-        try:
-            self.peers[peer].add(num)
-            self.rfcs.setdefault(num, (title, set()))[1].add(peer)
-        finally:
-            self.lock.release()
+        peer = (host, port)
+        self.leases.drop(peer)
+        self.scores.forget(peer)
+        nums = self.index.remove_peer(peer)[0]
+        if self.journal is not None:
+            self.journal.removed(peer)
+        if self.watchlist:
+            self.announce('removed', peer, nums)
+
+    def make_subscriber(self, session):
+        return PollSubscriber(self.V, session.channel, session.send_lock, self.schedule_flush)
+
+    # called from any thread; the poll thread writes the notifications
+    def schedule_flush(self, subscriber):
+        self.flushes.append(subscriber)
+        self.wake.send(b'.')
+
+    # watched RFCs among nums that peer does not hold yet
+    def unheld(self, peer, nums):
+        if not self.watchlist:
+            return []
+        return [num for num, _ in self.watchlist.subscribers(set(nums))
+                if peer not in (self.index.get(num) or ('', ()))[1]]
+
+    # push a change to watchers; called with no lock held
+    def announce(self, event, peer, nums):
+        for num, subscribers in self.watchlist.subscribers(nums):
+            entry = self.index.get(num)
+            data = notice(self.V, num, event, peer, entry and entry[0], len(entry[1]) if entry else 0)
+            for subscriber in subscribers:
+                subscriber.push(data)
+
+    # a peer registering again confirms the records restored for it
+    def confirm(self, peer, records):
+        self.provisional.discard(peer)
+        if self.journal is not None:
+            self.journal.added(peer, records)
+
+    def heartbeat(self, peer):
+        if peer not in self.index.peers:
+            # expired, or unknown since a restart: the peer has to ADD its files again
+            return self.V + ' 404 Not Found\n'
+        self.provisional.discard(peer)
+        self.leases.renew(peer, self.lease)
+        return self.V + ' 200 OK\nLease: %s\n' % self.lease
+
+    def addRecord(self, peer, num, title, root=None):
+        self.leases.renew(peer, self.lease)
+        watched = self.unheld(peer, [num])
+        title = self.index.add(peer, num, title, root)[0]
+        self.confirm(peer, [(num, title, root)])
+        if watched:
+            self.announce('added', peer, watched)
         header = self.V + ' 200 OK\n'
-        header += 'RFC %s %s %s %s\n' % (num, self.rfcs[num][0], peer[0], peer[1])
-        soc.sendall(str.encode(header))
+        header += 'RFC %s %s %s %s\n' % (num, title, peer[0], peer[1])
+        return header
+
+    def addRecords(self, peer, records):
+        self.leases.renew(peer, self.lease)
+        watched = self.unheld(peer, [record[0] for record in records])
+        entries = self.index.add_many(peer, records)
+        self.confirm(peer, records)
+        if watched:
+            self.announce('added', peer, watched)
+        header = self.V + ' 200 OK\n'
+        header += 'Count: %s\n' % len(entries)
+        return header
+
+    def getPeersOfRfc(self, num):
+        entry = self.index.get(num)
+        if entry is None:
+            return self.V + ' 404 Not Found\n'
+        title, peers, root = entry
+        # a peer whose lease ran out since the last sweep is as good as gone
+        peers = [peer for peer in peers if self.leases.alive(peer)]
+        if not peers:
+            return self.V + ' 404 Not Found\n'
+        # best reported first
+        peers = self.scores.rank(peers)
+        header = self.V + ' 200 OK\n'
+        if root:
+            header += 'Root: %s\n' % root
+        # holders known only from before a restart are listed last and flagged
+        restored = [peer for peer in peers if peer in self.provisional]
+        if restored:
+            header += 'Provisional: %s\n' % ', '.join('%s:%s' % peer for peer in restored)
+            peers = [peer for peer in peers if peer not in self.provisional] + restored
+        header += ''.join('RFC %s %s %s %s\n' % (num, title, peer[0], peer[1]) for peer in peers)
+        return header
+
+    # best matches first, skipping RFCs with no live holder
+    def search(self, query, limit):
+        records = []
+        for num in self.index.titles.search(query):
+            entry = self.index.get(num)
+            if entry is None:
+                continue
+            if any(self.leases.alive(peer) for peer in entry[1]):
+                records.append((num, entry[0], entry[1]))
+                if len(records) == limit:
+                    break
+        if not records:
+            return self.V + ' 404 Not Found\n'
+        return self.V + ' 200 OK\n' + self.formatRecords(records)
 
-    def getPeersOfRfc(self, soc, num):
-        self.lock.acquire()
+    def formatRecords(self, records):
+        alive = self.leases.alive
+        return ''.join('RFC %s %s %s %s\n' % (num, title, peer[0], peer[1])
+                       for num, title, peers in records for peer in peers if alive(peer))
+
+    def getRecordsPage(self, cursor, limit):
+        records, more = self.index.page(cursor, limit)
+        if not records:
+            return self.V + ' 404 Not Found\n'
+        header = self.V + ' 200 OK\n'
+        if more is not None:
+            header += 'Cursor: %s\n' % more
+        return header + self.formatRecords(records)
+
+    # stream the whole catalogue a page at a time, never holding a lock while sending
+    def getAllRecords(self):
+        records, more = self.index.page(-sys.maxsize, self.PAGE_SIZE)
+        if not records:
+            return self.V + ' 404 Not Found\n'
+        return self.streamRecords(records, more)
+
+    def streamRecords(self, records, more):
+        yield self.V + ' 200 OK\n' + self.formatRecords(records)
+        while more is not None:
+            records, more = self.index.page(more, self.PAGE_SIZE)
+            yield self.formatRecords(records)
+
+
+class AsyncServer(Server):
+    """Serves the same protocol from one asyncio event loop.
+
+    Every connection is a coroutine instead of an OS thread, so idle
+    registered peers only cost a socket and a small stream buffer.
+    """
+
+    def start(self):
         try:
-            if num not in self.rfcs:
-                header = self.V + ' 404 Not Found\n'
-            else:
-                header = self.V + ' 200 OK\n'
-                title = self.rfcs[num][0]
-                for peer in self.rfcs[num][1]:
-                    header += 'RFC %s %s %s %s\n' % (num, title, peer[0], peer[1])
-        finally:
-            self.lock.release()
-        soc.sendall(str.encode(header))
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            self.shutdown()
+
+    async def serve(self):
+        server = await asyncio.start_server(
+            self.handle_stream, self.HOST, self.PORT, backlog=self.backlog)
+        print('\n\n---------------Server %s is listening on port %s (asyncio)--------------' %
+              (self.V, self.PORT))
+        async with server:
+            await server.serve_forever()
+
+    def make_subscriber(self, session):
+        return StreamSubscriber(self.V, asyncio.get_running_loop(), session.channel, session)
 
-    def getAllRecords(self, soc):
-        self.lock.acquire()
+    # connect with a client
+    async def handle_stream(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        if self.connections >= self.max_connections:
+            writer.write(self.busy().encode())
+            writer.close()
+            return
+        self.connections += 1
+        event(log, logging.INFO, 'connected', addr='%s:%s' % addr[:2])
+        session = Session(addr, writer)
         try:
-            if not self.rfcs:
-                header = self.V + ' 404 Not Found\n'
-            else:
-                header = self.V + ' 200 OK\n'
-                for num in self.rfcs:
-                    title = self.rfcs[num][0]
-                    for peer in self.rfcs[num][1]:
-                        header += 'RFC %s %s %s %s\n' % (num, title, peer[0], peer[1])
+            while True:
+                # a started request must be finished quickly; a quiet connection may idle longer
+                if session.parser.pending():
+                    timeout = session.began + self.READ_TIMEOUT - time.monotonic()
+                else:
+                    timeout = self.idle_timeout
+                try:
+                    if timeout <= 0:
+                        raise asyncio.TimeoutError
+                    data = await asyncio.wait_for(reader.read(65536), timeout)
+                except asyncio.TimeoutError:
+                    if session.parser.pending():
+                        writer.write(str.encode(self.V + ' 408 Request Timeout\n\n'))
+                    break
+                if not data:
+                    break
+                session.writing = True
+                try:
+                    for chunk in self.process(session.read(data), session):
+                        if isinstance(chunk, Future):
+                            await asyncio.wait([asyncio.wrap_future(chunk)])
+                            continue
+                        writer.write(chunk)
+                        await asyncio.wait_for(writer.drain(), self.WRITE_TIMEOUT)
+                finally:
+                    session.writing = False
+                if session.subscriber is not None:
+                    session.subscriber.flush()
+        except (ProtocolError, ValueError):
+            writer.write(str.encode(self.V + ' 400 Bad Request\n\n'))
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
         finally:
-            self.lock.release()
-        soc.sendall(str.encode(header))
+            self.connections -= 1
+            self.leave(session)
+            writer.close()
 
 
 if __name__ == '__main__':
-    s = Server()
-    s.start()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='P2P-CI index server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=7734)
+    parser.add_argument('--mode', choices=('thread', 'async'), default='thread',
+                        help='a pool of worker threads, or a single asyncio event loop')
+    parser.add_argument('--state', default=os.path.join(ROOT_DIR, 'index_state'),
+                        help='directory for the index snapshot and log; empty to keep it in memory only')
+    parser.add_argument('--grace', type=float, default=Server.GRACE,
+                        help='seconds peers restored from disk have to register again')
+    parser.add_argument('--db', default=os.path.join(ROOT_DIR, 'users.db'),
+                        help='SQLite database of user accounts')
+    parser.add_argument('--lease', type=float, default=Server.LEASE,
+                        help='seconds a peer stays listed without a heartbeat')
+    parser.add_argument('--backlog', type=int, default=Server.BACKLOG,
+                        help='connections waiting to be accepted')
+    parser.add_argument('--workers', type=int, default=Server.WORKERS,
+                        help='threads answering requests (thread mode)')
+    parser.add_argument('--max-connections', type=int, default=Server.MAX_CONNECTIONS,
+                        help='open connections; more are refused with 503 and Retry-After')
+    parser.add_argument('--idle-timeout', type=float, default=Server.IDLE_TIMEOUT,
+                        help='seconds a silent connection is kept open')
+    parser.add_argument('--metrics-port', type=int,
+                        help='also serve the STATS metrics over HTTP at /metrics on this port')
+    parser.add_argument('--log-level', choices=logs.LEVELS, default='INFO',
+                        help='DEBUG logs every request')
+    parser.add_argument('--log-format', choices=('text', 'json'), default='text')
+    parser.add_argument('--log-file', help='write the log here rather than to stderr')
+    parser.add_argument('--log-sample', type=float, default=Server.LOG_SAMPLE,
+                        help='share of DEBUG request events that include the request text')
+    args = parser.parse_args()
+    handler = logs.setup(args.log_level, args.log_format == 'json', args.log_file)
+    server = AsyncServer if args.mode == 'async' else Server
+    s = server(args.host, args.port, state=args.state, grace=args.grace, lease=args.lease,
+               db=args.db, backlog=args.backlog, workers=args.workers,
+               max_connections=args.max_connections, idle_timeout=args.idle_timeout,
+               log_sample=args.log_sample)
+    s.metrics.gauge('p2p_log_dropped', lambda: handler.dropped, 'Log records dropped because the queue was full')
+    if args.metrics_port:
+        serve_http(s.metrics, args.host, args.metrics_port)
+    # kill and service managers stop us with SIGTERM; shut the hashing processes down with us
+    signal.signal(signal.SIGTERM, lambda *args: s.shutdown())
+    s.start()
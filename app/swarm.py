@@ -0,0 +1,223 @@
+import functools
+import platform
+import random
+import socket
+import threading
+import time
+
+from merkle import Verifier
+from pool import PeerPool
+
+
+class SwarmError(Exception):
+    pass
+
+
+class PieceFailed(Exception):
+    pass
+
+
+class PieceCancelled(Exception):
+    pass
+
+
+class Swarm(object):
+    """Download one RFC from every peer holding it at once.
+
+    The file is split into the pieces of a PartialDownload, fetched with
+    ranged GETs by one worker thread per peer; pieces already on disk from
+    an earlier attempt are skipped. Each worker asks pick() for its next piece:
+    the rarest piece nobody is fetching, where a piece is rarer the more
+    peers have failed to serve it. Pieces that fail or run far slower
+    than the swarm's best rate go back to the pool and the peer is
+    dropped after MAX_FAILURES. Once every missing piece is in flight,
+    idle workers duplicate the remaining ones (end game); the first copy
+    to arrive wins. Pieces are hashed by the Verifier while the worker
+    moves on; a piece that fails is fetched again from another peer.
+    Connections come from a PeerPool, so a worker keeps one connection
+    to its peer for all its pieces.
+    """
+    MAX_FAILURES = 3
+    TIMEOUT = 10  # seconds without progress before a peer is given up on
+    SLOW_FACTOR = 8  # abandon a piece taking this many times longer than at the best rate
+
+    def __init__(self, V, num, peers, partial, verifier=None, pool=None):
+        self.V = V
+        self.owns_pool = pool is None
+        self.pool = pool or PeerPool(timeout=self.TIMEOUT)
+        self.num = num
+        self.peers = list(peers)
+        self.partial = partial
+        self.verifier = verifier or Verifier()
+        self.done = partial.done
+        self.lock = threading.Condition()
+        self.pending = []
+        self.inflight = {}  # piece -> set of peers fetching it
+        self.verifying = {}  # piece -> copies waiting for their hash check
+        self.lacking = {}  # piece -> peers that failed to serve it
+        self.failures = {}  # peer -> consecutive failures
+        self.rates = {}  # peer -> bytes per second of its last piece
+        self.received = {}  # peer -> [bytes, seconds] of the pieces it delivered
+        self.failed = {}  # peer -> failed requests, all told
+
+    def run(self):
+        self.probe()
+        workers = [threading.Thread(target=self.worker, args=(peer,), daemon=True)
+                   for peer in self.peers]
+        try:
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self.verifier.wait()
+        finally:
+            self.partial.save(True)
+            if self.owns_pool:
+                self.pool.close()
+        if not self.partial.complete():
+            missing = len(self.partial.missing())
+            raise SwarmError('%s of %s pieces missing' % (missing, self.partial.pieces))
+        return self.partial.size
+
+    def transfers(self):
+        """(peer, bytes, seconds, failures) for every peer tried, for a REPORT."""
+        return [(peer,) + tuple(self.received.get(peer, (0, 0.0))) + (self.failed.get(peer, 0),)
+                for peer in set(self.received) | set(self.failed)]
+
+    # learn the file size from the first peer that answers
+    def probe(self):
+        for peer in list(self.peers):
+            try:
+                size = self.fetch(peer, 0, 0)[0]
+                break
+            except (OSError, PieceFailed):
+                self.peers.remove(peer)
+                self.failed[peer] = self.failed.get(peer, 0) + 1
+        else:
+            raise SwarmError('No Peer Available')
+        self.partial.start(size)
+        self.done = self.partial.done
+        self.pending = self.partial.missing()
+
+    def pick(self, peer):
+        with self.lock:
+            while True:
+                if self.failures.get(peer, 0) >= self.MAX_FAILURES:
+                    return None
+                candidates = [p for p in self.pending if peer not in self.lacking.get(p, ())]
+                if candidates:
+                    rarest = max(len(self.lacking.get(p, ())) for p in candidates)
+                    piece = random.choice([p for p in candidates
+                                           if len(self.lacking.get(p, ())) == rarest])
+                    self.pending.remove(piece)
+                    break
+                # end game: help with whatever is still in flight
+                busy = [p for p, holders in self.inflight.items()
+                        if p not in self.done and p not in self.verifying
+                        and peer not in holders and peer not in self.lacking.get(p, ())]
+                if busy:
+                    piece = min(busy, key=lambda p: len(self.inflight[p]))
+                    break
+                if not self.verifying:
+                    return None
+                # a piece under verification may yet fail and need fetching again
+                self.lock.wait()
+            self.inflight.setdefault(piece, set()).add(peer)
+            return piece
+
+    def verified(self, peer, piece, data, ok):
+        if ok:
+            self.partial.write(piece, data)
+        with self.lock:
+            self.verifying[piece] -= 1
+            if not self.verifying[piece]:
+                del self.verifying[piece]
+        self.release(piece, peer, not ok)
+
+    def release(self, piece, peer, failed):
+        with self.lock:
+            self.lock.notify_all()
+            holders = self.inflight.get(piece)
+            if holders is not None:
+                holders.discard(peer)
+                if not holders:
+                    del self.inflight[piece]
+                    if piece not in self.done:
+                        self.pending.append(piece)
+            if failed:
+                self.lacking.setdefault(piece, set()).add(peer)
+                self.failures[peer] = self.failures.get(peer, 0) + 1
+            else:
+                self.failures[peer] = 0
+            return self.failures[peer] < self.MAX_FAILURES
+
+    def worker(self, peer):
+        while True:
+            piece = self.pick(peer)
+            if piece is None:
+                return
+            start, end = self.partial.bounds(piece)
+            began = time.monotonic()
+            try:
+                _, data = self.fetch(peer, start, end, piece)
+            except PieceCancelled:
+                self.release(piece, peer, False)
+                continue
+            except (OSError, PieceFailed):
+                self.failed[peer] = self.failed.get(peer, 0) + 1
+                if not self.release(piece, peer, True):
+                    return
+                continue
+            elapsed = time.monotonic() - began
+            self.rates[peer] = len(data) / max(elapsed, 1e-6)
+            received = self.received.setdefault(peer, [0, 0.0])
+            received[0] += len(data)
+            received[1] += elapsed
+            with self.lock:
+                self.verifying[piece] = self.verifying.get(piece, 0) + 1
+            self.verifier.submit(piece, data, functools.partial(self.verified, peer))
+
+    # longest a piece may take before we assume the peer has become slow
+    def deadline(self, length):
+        best = max(self.rates.values(), default=0)
+        if not best:
+            return None
+        return time.monotonic() + max(self.TIMEOUT, self.SLOW_FACTOR * length / best)
+
+    def fetch(self, peer, start, end, piece=None):
+        """Ranged GET of bytes start..end; returns (file size, data)."""
+        msg = 'GET RFC %s %s\n' % (self.num, self.V)
+        msg += 'Host: %s\n' % socket.gethostname()
+        msg += 'OS: %s\n' % platform.platform()
+        msg += 'Range: bytes=%s-%s\n' % (start, end)
+        soc, reader, res = self.pool.request(peer, msg)
+        try:
+            status = res.start[1]
+            if status == '206':
+                size = int(res.header('Content-Range').rsplit('/', 1)[1])
+            elif status == '200' and start == 0:
+                # peer without Range support: take the head of the full file
+                size = res.length
+            elif status == '416' and start == 0:
+                size, data = int(res.header('Content-Range').rsplit('/', 1)[1]), b''
+                self.pool.release(peer, soc, reader)
+                return size, data
+            else:
+                raise PieceFailed(' '.join(res.start[1:]))
+            length = min(end, size - 1) - start + 1
+            deadline = self.deadline(length)
+            data = bytearray()
+            for chunk in reader.iter_body(length):
+                data += chunk
+                if piece is not None and piece in self.done:
+                    raise PieceCancelled('Completed Elsewhere')
+                if deadline is not None and time.monotonic() > deadline:
+                    raise PieceFailed('Peer Too Slow')
+            if length == len(data) == res.length:
+                self.pool.release(peer, soc, reader)
+            else:
+                soc.close()  # a 200 whose tail we did not read
+            return size, bytes(data)
+        except BaseException:
+            soc.close()
+            raise
@@ -0,0 +1,188 @@
+import itertools
+import json
+import os
+import threading
+import time
+
+
+def send_file(soc, file, offset=0, count=None, bufsize=65536):
+    """Send count bytes of an open binary file, starting at offset.
+
+    socket.sendfile hands the copy to the kernel's sendfile, so file data
+    never passes through Python objects. Sockets without it, or whose
+    sendfile refuses this socket or file before sending anything, get
+    the buffered loop.
+    """
+    if count is None:
+        count = os.fstat(file.fileno()).st_size - offset
+    if count <= 0:
+        return 0  # socket.sendfile would take a count of 0 as the rest of the file
+    try:
+        return soc.sendfile(file, offset, count)
+    except (AttributeError, ValueError):
+        return send_buffered(soc, file, offset, count, bufsize)
+
+
+def send_buffered(soc, file, offset, count, bufsize=65536):
+    """Copy through one reused buffer; returns the number of bytes sent."""
+    buf = bytearray(min(bufsize, count) or 1)
+    view = memoryview(buf)
+    file.seek(offset)
+    sent = 0
+    while sent < count:
+        n = file.readinto(view[:min(len(buf), count - sent)])
+        if not n:
+            break
+        soc.sendall(view[:n])
+        sent += n
+    return sent
+
+
+def parse_range(value, size):
+    """Parse 'bytes=<start>-[<end>]' against a file of size bytes.
+
+    Returns the inclusive (start, end); raises ValueError if unsatisfiable.
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip() != 'bytes':
+        raise ValueError('Unsupported Range Unit')
+    start, _, end = spec.strip().partition('-')
+    start = int(start)
+    end = int(end) if end else size - 1
+    end = min(end, size - 1)
+    if start < 0 or start > end:
+        raise ValueError('Range Not Satisfiable')
+    return start, end
+
+
+class PartialDownload(object):
+    """A download that survives interruption.
+
+    Bytes go to <path>.part and the numbers of the finished pieces to
+    <path>.part.json, so a retried or restarted download, from the same
+    peer or another one, only fetches the pieces still missing. finish()
+    moves the completed file into place. The pieces kept were checked
+    against root, the Merkle root the server published; a download under
+    a different root, or none, starts over rather than mix two versions.
+    """
+    PIECE_SIZE = 1 << 20
+    SAVE_INTERVAL = 1.0  # seconds between state writes while downloading
+
+    def __init__(self, path, piece_size=None, root=None):
+        self.path = path
+        self.root = root
+        self.part = path + '.part'
+        self.state = self.part + '.json'
+        self.piece_size = piece_size or self.PIECE_SIZE
+        self.size = None
+        self.done = set()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.saved = 0
+        try:
+            with open(self.state) as file:
+                state = json.load(file)
+            if (state['piece_size'] == self.piece_size and state.get('root') == root
+                    and os.path.isfile(self.part)):
+                self.size = state['size']
+                self.done = set(state['done'])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    @property
+    def pieces(self):
+        return max(1, -(-self.size // self.piece_size))
+
+    def bounds(self, piece):
+        start = piece * self.piece_size
+        return start, min(start + self.piece_size, self.size) - 1
+
+    def missing(self):
+        return [piece for piece in range(self.pieces) if piece not in self.done]
+
+    def first_missing(self):
+        """Offset to resume a sequential download from."""
+        if self.size is None:
+            return 0
+        missing = self.missing()
+        return missing[0] * self.piece_size if missing else self.size
+
+    def complete(self):
+        return self.size is not None and len(self.done) >= self.pieces
+
+    def reset(self):
+        self.size = None
+        self.done = set()
+
+    def start(self, size):
+        """Begin, or keep resuming, a download of size bytes; a size change starts over."""
+        if size == self.size:
+            return
+        self.size = size
+        self.done = set()
+        with open(self.part, 'wb') as file:
+            file.truncate(size)
+        self.save(True)
+
+    def write(self, piece, data):
+        """Store a whole piece; returns False if it was already done."""
+        with self.lock:
+            if piece in self.done:
+                return False
+            with open(self.part, 'r+b') as file:
+                file.seek(piece * self.piece_size)
+                file.write(data)
+            self.done.add(piece)
+        self.save()
+        return True
+
+    def save(self, force=False):
+        with self.save_lock:
+            now = time.monotonic()
+            if not force and now - self.saved < self.SAVE_INTERVAL:
+                return
+            self.saved = now
+            with self.lock:
+                state = {'size': self.size, 'piece_size': self.piece_size, 'root': self.root,
+                         'done': sorted(self.done)}
+            with open(self.state + '.tmp', 'w') as file:
+                json.dump(state, file)
+            os.replace(self.state + '.tmp', self.state)
+
+    def finish(self):
+        os.replace(self.part, self.path)
+        try:
+            os.remove(self.state)
+        except OSError:
+            pass
+
+
+def receive(partial, offset, chunks, verifier):
+    """Cut a sequential body starting at a piece boundary into pieces and store them.
+
+    Each piece goes through the verifier before it is written. Returns the
+    pieces that failed verification.
+    """
+    bad = []
+
+    def stored(piece, data, ok):
+        if ok:
+            partial.write(piece, data)
+        else:
+            bad.append(piece)
+
+    piece = offset // partial.piece_size
+    buf = bytearray()
+    try:
+        for chunk in itertools.chain(chunks, [b'']):
+            buf += chunk
+            while piece < partial.pieces:
+                start, end = partial.bounds(piece)
+                if len(buf) < end - start + 1:
+                    break
+                verifier.submit(piece, bytes(buf[:end - start + 1]), stored)
+                del buf[:end - start + 1]
+                piece += 1
+    finally:
+        verifier.wait()
+    return bad
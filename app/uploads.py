@@ -0,0 +1,171 @@
+import collections
+import threading
+import time
+
+from protocol import frame_chunk
+from transfer import send_file
+
+
+class TokenBucket(object):
+    """A rate limit of rate bytes per second, with bursts of up to burst bytes.
+
+    take() reserves its bytes before it sleeps, so callers are served in
+    the order they asked: uploads that each take one quantum at a time
+    take turns and share the rate evenly. rate 0 means no limit.
+    """
+
+    def __init__(self, rate=0, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst or max(rate // 4, 1 << 16)
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.free_at = 0.0  # when every reserved byte will have been paid for
+
+    def take(self, n):
+        if not self.rate:
+            return
+        with self.lock:
+            now = self.clock()
+            self.free_at = max(self.free_at, now - self.burst / self.rate) + n / self.rate
+            wait = self.free_at - now
+        if wait > 0:
+            self.sleep(wait)
+
+
+class Busy(Exception):
+    """No upload slot came free in time; retry_after is a hint in seconds."""
+
+    def __init__(self, retry_after):
+        Exception.__init__(self, 'Upload Slots Busy')
+        self.retry_after = retry_after
+
+
+class Upload(object):
+    def __init__(self, scheduler, peer, num):
+        self.scheduler = scheduler
+        self.peer = peer
+        self.num = num
+        self.sent = 0
+        self.started = time.monotonic()
+
+    @property
+    def rate(self):
+        """Bytes per second since the slot was granted."""
+        return self.sent / max(time.monotonic() - self.started, 1e-6)
+
+    def send(self, soc, file, offset, count):
+        """Send count bytes of file from offset, within the scheduler's rate."""
+        # without a rate limit there is nobody to take turns with
+        quantum = self.scheduler.QUANTUM if self.scheduler.bucket.rate else count
+        end = offset + count
+        while offset < end:
+            n = min(quantum, end - offset)
+            self.scheduler.bucket.take(n)
+            n = send_file(soc, file, offset, n)
+            if not n:
+                break
+            offset += n
+            self.sent += n
+        return self.sent
+
+    def send_chunks(self, soc, chunks):
+        """Send byte strings as they come, with chunked framing, within the scheduler's rate."""
+        quantum = self.scheduler.QUANTUM
+        for data in chunks:
+            for i in range(0, len(data), quantum):
+                piece = data[i:i + quantum]
+                self.scheduler.bucket.take(len(piece))
+                soc.sendall(frame_chunk(piece))
+                self.sent += len(piece)
+        soc.sendall(frame_chunk(b''))
+        return self.sent
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.scheduler.release(self)
+
+
+class UploadScheduler(object):
+    """Upload slots for the peer server.
+
+    At most slots uploads run at once. Further requests wait, up to
+    max_queued of them and for at most wait seconds each; past that they
+    are turned away with Busy and should be retried later. A freed slot
+    goes to the downloader that has waited longest among those with the
+    fewest uploads running, so a peer with many connections cannot crowd
+    out the others. All uploads together stay under rate bytes per
+    second (0 for no limit), each getting an even share of it.
+    """
+    SLOTS = 4
+    MAX_QUEUED = 16
+    WAIT = 8  # seconds; below the downloader's socket timeout
+    QUANTUM = 1 << 16  # bytes sent per turn at the rate limit
+
+    def __init__(self, slots=SLOTS, rate=0, max_queued=MAX_QUEUED, wait=WAIT):
+        self.slots = slots
+        self.max_queued = max_queued
+        self.wait = wait
+        self.bucket = TokenBucket(rate)
+        self.lock = threading.Lock()
+        self.active = []
+        self.waiting = collections.OrderedDict()  # ticket -> downloader host, oldest first
+        self.granted = threading.Condition(self.lock)
+        self.tickets = 0
+        self.served = 0
+        self.rejected = 0
+        self.total_sent = 0
+
+    def acquire(self, peer, num):
+        """An Upload holding a slot, to be used as a context manager; raises Busy."""
+        with self.lock:
+            if len(self.active) < self.slots and not self.waiting:
+                return self.grant(peer, num)
+            if len(self.waiting) >= self.max_queued:
+                self.rejected += 1
+                raise Busy(self.retry_after())
+            self.tickets += 1
+            ticket = self.tickets
+            self.waiting[ticket] = peer[0]
+            deadline = time.monotonic() + self.wait
+            try:
+                while not (len(self.active) < self.slots and self.next_ticket() == ticket):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise Busy(self.retry_after())
+                    self.granted.wait(remaining)
+            finally:
+                del self.waiting[ticket]
+                # the next in line may be able to go too
+                self.granted.notify_all()
+            return self.grant(peer, num)
+
+    def next_ticket(self):
+        running = collections.Counter(upload.peer[0] for upload in self.active)
+        return min(self.waiting, key=lambda ticket: (running[self.waiting[ticket]], ticket))
+
+    def grant(self, peer, num):
+        upload = Upload(self, peer, num)
+        self.active.append(upload)
+        return upload
+
+    def release(self, upload):
+        with self.lock:
+            self.active.remove(upload)
+            self.served += 1
+            self.total_sent += upload.sent
+            self.granted.notify_all()
+
+    def retry_after(self):
+        return max(1, int(self.wait))
+
+    def stats(self):
+        with self.lock:
+            return {'slots': self.slots, 'active': len(self.active), 'queued': len(self.waiting),
+                    'served': self.served, 'rejected': self.rejected,
+                    'sent': self.total_sent + sum(upload.sent for upload in self.active),
+                    'rate_limit': self.bucket.rate,
+                    'uploads': [(upload.peer, upload.num, upload.sent, upload.rate) for upload in self.active]}
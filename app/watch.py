@@ -0,0 +1,209 @@
+import collections
+import socket
+import threading
+
+from protocol import frame
+
+NO_WAIT = getattr(socket, 'MSG_DONTWAIT', 0)  # one send that does not block, leaving the socket's timeout alone
+
+
+def notice(V, num, event, peer, title=None, holders=None):
+    """The NOTIFY message pushed to watchers of an RFC."""
+    msg = 'NOTIFY RFC %s %s\n' % (num, V)
+    msg += 'Event: %s\n' % event
+    if holders is not None:
+        msg += 'Holders: %s\n' % holders
+    if peer is not None:
+        msg += 'Host: %s\n' % peer[0]
+        msg += 'Port: %s\n' % peer[1]
+    if title is not None:
+        msg += 'Title: %s\n' % title
+    return frame(msg)
+
+
+class Subscriber(object):
+    """Outbound queue of notifications for one watching connection.
+
+    At most LIMIT notifications wait to be written. A subscriber too slow
+    to keep up loses what is queued and gets one overflow notice in its
+    place, after which it should LOOKUP its RFCs again. The queue never
+    holds back the peers whose changes caused the notifications.
+    """
+    LIMIT = 256
+
+    def __init__(self, V):
+        self.V = V
+        self.lock = threading.Lock()
+        self.queue = collections.deque()
+        self.closed = False
+
+    def push(self, data):
+        with self.lock:
+            if self.closed:
+                return
+            if len(self.queue) >= self.LIMIT:
+                self.queue.clear()
+                self.queue.append(notice(self.V, '*', 'overflow', None))
+            self.queue.append(data)
+        self.wake()
+
+    def take(self):
+        with self.lock:
+            data = b''.join(self.queue)
+            self.queue.clear()
+            return data
+
+    def wake(self):
+        raise NotImplementedError
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.queue.clear()
+        self.wake()
+
+
+class PollSubscriber(Subscriber):
+    """Writes notifications from the server's poll thread, never waiting on the peer.
+
+    wake() asks the poll thread to call flush(), which writes what the
+    socket takes at once, and only between whole responses, when the send
+    lock is free. The rest of a notification cut short stays in partial
+    and goes out before anything else on the connection.
+    """
+
+    def __init__(self, V, soc, send_lock, schedule):
+        super().__init__(V)
+        self.soc = soc
+        self.send_lock = send_lock  # held by the handler while it sends responses
+        self.schedule = schedule  # asks the poll thread to flush this subscriber
+        self.partial = b''
+
+    def wake(self):
+        self.schedule(self)
+
+    def flush(self):
+        """Write without blocking; returns False while something is left to write."""
+        if not self.send_lock.acquire(False):
+            return False
+        try:
+            if self.closed:
+                return True
+            # nothing more is taken until the peer reads, so the queue's limit holds
+            data = self.partial or self.take()
+            if not data:
+                return True
+            try:
+                sent = self.soc.send(data, NO_WAIT)
+            except (BlockingIOError, socket.timeout):
+                sent = 0
+            except OSError:
+                return True  # the handler finds out on its own
+            self.partial = data[sent:]
+            return not self.partial
+        finally:
+            self.send_lock.release()
+
+    def cut(self):
+        """Caller holds the send lock: the rest of a notification cut short, to send first."""
+        data, self.partial = self.partial, b''
+        return data
+
+
+class StreamSubscriber(Subscriber):
+    """Writes notifications to an asyncio stream from its event loop.
+
+    Nothing is written while session.writing is set: a response is half
+    sent, and the handler calls flush() once it is done.
+    """
+    HIGH_WATER = 1 << 16  # bytes in the transport buffer before notifications wait in the queue
+
+    def __init__(self, V, loop, writer, session):
+        super().__init__(V)
+        self.loop = loop
+        self.writer = writer
+        self.session = session
+        self.draining = False
+
+    def wake(self):
+        try:
+            self.loop.call_soon_threadsafe(self.flush)
+        except RuntimeError:
+            pass  # event loop already closed
+
+    def flush(self):
+        if self.closed or self.session.writing or self.draining:
+            return
+        if self.writer.transport.get_write_buffer_size() > self.HIGH_WATER:
+            self.draining = True
+            self.loop.create_task(self.drain())
+            return
+        data = self.take()
+        if data:
+            self.writer.write(data)
+
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            return
+        finally:
+            self.draining = False
+        self.flush()
+
+
+class Watchlist(object):
+    """Which connections watch which RFCs.
+
+    subscribers() copies the watchers out under the lock; the caller
+    pushes to them after it is released, and after the index locks are,
+    so a notification never holds up an ADD or a peer removal.
+    """
+    MAX_WATCH = 10000  # RFCs one connection may watch
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.watchers = {}  # num -> set of subscribers
+        self.watching = {}  # subscriber -> set of nums
+
+    def __bool__(self):
+        return bool(self.watchers)
+
+    def watch(self, subscriber, nums):
+        with self.lock:
+            watched = self.watching.setdefault(subscriber, set())
+            if len(watched | set(nums)) > self.MAX_WATCH:
+                raise ValueError('Too Many Watches')
+            for num in nums:
+                watched.add(num)
+                self.watchers.setdefault(num, set()).add(subscriber)
+            return len(watched)
+
+    def unwatch(self, subscriber, nums):
+        with self.lock:
+            watched = self.watching.get(subscriber, set())
+            for num in nums:
+                watched.discard(num)
+                self._forget(subscriber, num)
+            return len(watched)
+
+    def drop(self, subscriber):
+        with self.lock:
+            for num in self.watching.pop(subscriber, ()):
+                self._forget(subscriber, num)
+        subscriber.close()
+
+    # caller holds the lock
+    def _forget(self, subscriber, num):
+        subscribers = self.watchers.get(num)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.watchers[num]
+
+    def subscribers(self, nums):
+        """[(num, subscribers)] for the watched RFCs among nums."""
+        with self.lock:
+            if len(nums) > len(self.watchers):
+                nums = [num for num in self.watchers if num in nums]
+            return [(num, list(self.watchers[num])) for num in nums if num in self.watchers]